@@ -0,0 +1,62 @@
+"""
+Page backgrounds: flat colors, gradients and user images
+"""
+import hashlib
+import io
+import os
+import tempfile
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+BACKGROUNDS_DIR = Path('.') / 'backgrounds'
+
+# Uploaded images are shrunk to fit this size, pages are smaller anyway
+MAX_BACKGROUND_SIDE = 1600
+
+
+class BackgroundError(Exception):
+    """Uploaded file is not a usable image"""
+
+
+def store_background(data: bytes) -> str:
+    """Decode image, save it as JPEG once per content and return the file name"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Decompression bombs are refused by Pillow while loading
+        image.load()
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as exception:
+        raise BackgroundError(f'image can not be read: {exception}') from exception
+
+    image.thumbnail((MAX_BACKGROUND_SIDE, MAX_BACKGROUND_SIDE))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    encoded = output.getvalue()
+
+    file_name = hashlib.sha256(encoded).hexdigest() + '.jpg'
+    path = BACKGROUNDS_DIR / file_name
+    if not path.exists():
+        BACKGROUNDS_DIR.mkdir(parents=True, exist_ok=True)
+        # Render workers never see a partially written file
+        with tempfile.NamedTemporaryFile(dir=BACKGROUNDS_DIR, delete=False) as temporary:
+            temporary.write(encoded)
+        os.replace(temporary.name, path)
+    return file_name
+
+
+def make_background(key, size):
+    """Page template of the background, None if there is nothing but a color to draw"""
+    if key is None:
+        return None
+
+    if key[0] == 'gradient':
+        _, top_color, bottom_color = key
+        mask = Image.linear_gradient('L').resize(size, Image.BILINEAR)
+        return Image.composite(Image.new('RGB', size, bottom_color), Image.new('RGB', size, top_color), mask)
+
+    path = BACKGROUNDS_DIR / key[1]
+    if not path.is_file():
+        return None
+    with Image.open(path) as image:
+        return ImageOps.fit(image.convert('RGB'), size, Image.LANCZOS)
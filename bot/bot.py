@@ -1,74 +1,207 @@
 """
 Telegram bot
 """
-import io
+import hashlib
 import logging
+import os
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import ExitStack
 from datetime import datetime
-from pathlib import Path
+from threading import Event, Lock
 
-from PIL import ImageFont
-from pymongo import MongoClient
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from PIL import Image
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import CollectionInvalid
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaDocument, \
+    InlineQueryResultCachedPhoto
 from telegram.ext import Updater, CommandHandler, CallbackContext, MessageHandler, Filters, CallbackQueryHandler, \
-    ConversationHandler
-
-from color_recognition import text_to_rgb
-from secrets import TELEGRAM_BOT_TOKEN
-from text_to_image import TextToImages
-
-DEFAULT_FONT_FAMILY = 'roboto'
-DEFAULT_FONT_SIZE = 40
-DEFAULT_FONT_COLOR = (0, 0, 0)
-DEFAULT_BACKGROUND_COLOR = (255, 255, 255)
-DEFAULT_ORIENTATION = 'square'
-DEFAULT_ALIGNMENT = 'left'
-
-DEFAULT_IMG_WIDTH = 720
-
-FONTS = {'roboto': 'Roboto-Regular.ttf',
-         'raleway': 'Raleway-Regular.ttf',
-         'playfair': 'PlayfairDisplay-Regular.ttf'}
-
-ORIENTATION = {'square': (DEFAULT_IMG_WIDTH, DEFAULT_IMG_WIDTH),
-               'vertical': (DEFAULT_IMG_WIDTH, DEFAULT_IMG_WIDTH // 4 * 5),
-               'horizontal': (DEFAULT_IMG_WIDTH, DEFAULT_IMG_WIDTH // 16 * 9),
-               'stories': (DEFAULT_IMG_WIDTH, DEFAULT_IMG_WIDTH // 9 * 16)}
+    ConversationHandler, InlineQueryHandler, ChosenInlineResultHandler, Dispatcher, TypeHandler
+from telegram.error import BadRequest, RetryAfter
+
+from backgrounds import BackgroundError, store_background
+from cache import LRUCache
+from color_recognition import normalize_color, text_to_rgb
+from config import DEFAULT_DOCUMENT, UserConfig, compact_update
+from custom_fonts import MAX_FONT_FILE_SIZE, FontError, store_font
+from documents import iter_document_lines
+from fanout import FanOut
+from pdf import RasterPdfWriter, VectorPdfWriter
+from persistence import MongoPersistence
+from rendering import DEFAULT_FONT_FAMILY, DEFAULT_FONT_SIZE, DEFAULT_ORIENTATION, DEFAULT_ALIGNMENT, DEFAULT_OUTPUT, \
+    create_renderer, fallback_files, font_files
+from render_pool import RenderPool
+from secrets import TELEGRAM_BOT_TOKEN, INLINE_CACHE_CHAT_ID
+from stats import error_key, record_activity, record_error, record_new_user, record_render
+from text_to_image import entities_to_runs
 
 COLOR, BGCOLOR = range(2)
 
-HELP_MESSAGE = '/font — выбор шрифта\n' \
+HELP_MESSAGE = '/font — выбор шрифта, можно прислать свой в файле TTF или OTF\n' \
                '/size — выбор размера шрифта\n' \
                '/orientation — форма изображения\n' \
                '/color — выбор цвета текста\n' \
                '/bgcolor — выбор цвета фона\n' \
+               '/gradient — градиент от цвета фона к другому цвету\n' \
+               'Пришли фото, чтобы поставить его фоном\n' \
+               '/output — изображения или PDF\n' \
                '/reset — сброс параметров'
 
 ET_UNKNOWN_COLOR = 'unknown color'
+# New errors are also written to a capped collection, the admin live feed tails it
+ERROR_EVENTS_SIZE = 16 * 1024 * 1024
+
+# Inline mode previews are rendered this times smaller than full-size images
+INLINE_THUMB_SCALE = 3
+# Wait for the user to stop typing before rendering an inline query, seconds
+INLINE_DEBOUNCE_DELAY = 0.4
+INLINE_CACHE_SIZE = 10000
+
+USER_CONFIGS_CACHE_SIZE = 10000
+# Replies of this many recent text messages are kept to be updated when the messages are edited
+SENT_RENDERS_CACHE_SIZE = 10000
+
+# Pages of text documents are sent in albums of this size
+ALBUM_SIZE = 10
+# Pages limit of text documents for a user within the window, seconds
+MAX_DOCUMENT_PAGES = 100
+DOCUMENT_PAGES_WINDOW = 24 * 60 * 60
+DOCUMENT_PAGES_CACHE_SIZE = 10000
+# Bot API doesn't let bots download bigger files
+MAX_DOCUMENT_SIZE = 20 * 1024 * 1024
+
+# Render images in this many separate processes, 0 to render in the bot process.
+# With BOT_WORKERS each bot worker has its own render processes, BOT_WORKERS * RENDER_WORKERS in total
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 0))
+# Process updates in this many processes partitioned by chat, 0 to process them in the polling process
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 0))
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
-db = MongoClient('mongodb://mongo').instaimg
+# Spawned processes import this module again, the ones which don't use MongoDB never connect
+db = MongoClient('mongodb://mongo', connect=False).instaimg
 configs_db = db.configs
 errors_db = db.errors
+error_events_db = db.error_events
+stats_db = db.stats
 
+# Started by the process handling updates, see start_render_pool
+render_pool = None
 
-def update_last_activity(chat_id: int):
-    """Update last user activity date in MongoDB"""
-    user_query = {'_id': chat_id}
-    configs_db.update_one(user_query, {'$set': {'last-activity': datetime.utcnow()}})
+user_configs = LRUCache(USER_CONFIGS_CACHE_SIZE)
+# Query hash -> uploaded preview file_id
+inline_previews = LRUCache(INLINE_CACHE_SIZE)
+
+# Rendering of a text message: user config, hashes of the pages lines and ids of the reply messages
+SentRender = namedtuple('SentRender', 'config page_hashes message_ids')
+# (chat id, message id) -> SentRender
+sent_renders = LRUCache(SENT_RENDERS_CACHE_SIZE)
+
+
+class Debouncer:
+    """Let through only the latest of rapidly changing user queries"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._latest = {}
+        self._lock = Lock()
+
+    def settle(self, user_id: int, query_id: str) -> bool:
+        """Wait for a pause and return True if the query was not superseded by a newer one"""
+        with self._lock:
+            self._latest[user_id] = query_id
+        time.sleep(self.delay)
+        with self._lock:
+            if self._latest.get(user_id) != query_id:
+                return False
+            del self._latest[user_id]
+            return True
+
+
+inline_debouncer = Debouncer(INLINE_DEBOUNCE_DELAY)
+
+# Chat id -> cancellation event of the text document being processed
+document_jobs = {}
+# Chat id -> times and counts of the pages sent from text documents within the window
+document_pages = LRUCache(DOCUMENT_PAGES_CACHE_SIZE)
+document_jobs_lock = Lock()
+
+
+def document_pages_left(chat_id: int) -> int:
+    """Pages of text documents the user can get until the window of the earlier ones passes"""
+    with document_jobs_lock:
+        now = time.monotonic()
+        sent = [(sent_at, pages) for sent_at, pages in document_pages.get(chat_id, ())
+                if now - sent_at < DOCUMENT_PAGES_WINDOW]
+        document_pages[chat_id] = sent
+        return MAX_DOCUMENT_PAGES - sum(pages for _, pages in sent)
 
 
-def add_error(chat_id: int, error_type: str, msg: str):
-    """Update last user activity date in MongoDB"""
+def count_document_pages(chat_id: int, pages: int):
+    """Count pages sent to the user from a text document"""
+    with document_jobs_lock:
+        document_pages[chat_id] = [*document_pages.get(chat_id, ()), (time.monotonic(), pages)]
 
+
+def update_last_activity(chat_id: int):
+    """Update last user activity date in MongoDB and count the user as active"""
+    now = datetime.utcnow()
+    previous = configs_db.find_one_and_update({'_id': chat_id},
+                                              {'$set': {'last-activity': now}},
+                                              projection={'last-activity': True},
+                                              return_document=ReturnDocument.BEFORE)
+    if previous is not None:
+        record_activity(stats_db, previous.get('last-activity'), now)
+
+
+def add_error(chat_id: int, error_type: str, msg: str, key: str = None):
+    """Store error in MongoDB and count it in the group of the key, the normalized message by default"""
+    now = datetime.utcnow()
+    key = error_key(msg) if key is None else key
     query = {'chat_id': chat_id,
-             'timestamp': datetime.utcnow(),
+             'timestamp': now,
              'msg': msg,
              'type': error_type,
+             'key': key,
              'solved': False}
     errors_db.insert_one(query)
+    error_events_db.insert_one({'event': 'new', 'error': query})
+    record_error(db, error_type, key, msg, now)
+
+
+def create_error_events():
+    """Create the capped collection of error events unless it exists"""
+    try:
+        db.create_collection(error_events_db.name, capped=True, size=ERROR_EVENTS_SIZE)
+    except CollectionInvalid:
+        pass
+
+
+def get_user_config(chat_id: int) -> UserConfig:
+    """Get user config from cache or MongoDB, create default one for a new user"""
+    user_config = user_configs.get(chat_id)
+    if user_config is not None:
+        return user_config
+
+    user_config = configs_db.find_one({'_id': chat_id})
+    if not user_config:
+        # Default values are not stored
+        user_config = {'_id': chat_id}
+        configs_db.insert_one(user_config)
+        record_new_user(stats_db)
+
+    user_config = UserConfig.from_document(user_config)
+    user_configs[chat_id] = user_config
+    return user_config
+
+
+def set_user_config(chat_id: int, set_query: dict):
+    """Update user config in MongoDB and drop the cached copy"""
+    configs_db.update_one({'_id': chat_id}, compact_update(set_query))
+    user_configs.pop(chat_id)
 
 
 def start(update: Update, context: CallbackContext) -> None:  # pylint: disable=unused-argument
@@ -135,35 +268,56 @@ def parse_alignment_button(data):
     return {'alignment': DEFAULT_ALIGNMENT}, 'слева'
 
 
+def parse_output_button(data):
+    """Parse data returned by output format selection"""
+    if data == 'output_photos':
+        return {'output': 'photos'}, 'изображения'
+    if data == 'output_pdf':
+        return {'output': 'pdf'}, 'PDF'
+    if data == 'output_vector':
+        return {'output': 'vector-pdf'}, 'векторный PDF'
+
+    return {'output': DEFAULT_OUTPUT}, 'изображения'
+
+
 def button(update: Update, context: CallbackContext) -> None:  # pylint: disable=unused-argument
     """Button press"""
     query = update.callback_query
     query.answer()
 
-    user_query = {'_id': update.effective_chat.id}
-
     if query.data.startswith('font'):
         set_query, selected_font = parse_font_button(query.data)
-        configs_db.update_one(user_query, {'$set': set_query})
+        set_user_config(update.effective_chat.id, set_query)
         query.edit_message_text(text=f'Выбранный шрифт: {selected_font}')
         return
 
     if query.data.startswith('size'):
         set_query, selected_size = parse_font_size_button(query.data)
-        configs_db.update_one(user_query, {'$set': set_query})
+        set_user_config(update.effective_chat.id, set_query)
         query.edit_message_text(text=f'Выбранный размер шрифта: {selected_size}')
         return
 
     if query.data.startswith('orientation'):
         set_query, selected_orientation = parse_orientation_button(query.data)
-        configs_db.update_one(user_query, {'$set': set_query})
+        set_user_config(update.effective_chat.id, set_query)
         query.edit_message_text(text=f'Выбранная форма изображения: {selected_orientation}')
 
     if query.data.startswith('alignment'):
         set_query, selected_alignment = parse_alignment_button(query.data)
-        configs_db.update_one(user_query, {'$set': set_query})
+        set_user_config(update.effective_chat.id, set_query)
         query.edit_message_text(text=f'Выбранное выравнивание текста: {selected_alignment}')
 
+    if query.data.startswith('output'):
+        set_query, selected_output = parse_output_button(query.data)
+        set_user_config(update.effective_chat.id, set_query)
+        query.edit_message_text(text=f'Выбранный формат: {selected_output}')
+
+    if query.data == 'job_cancel':
+        with document_jobs_lock:
+            cancelled = document_jobs.get(update.effective_chat.id)
+        if cancelled:
+            cancelled.set()
+
     update_last_activity(update.effective_chat.id)
 
 
@@ -234,6 +388,20 @@ def alignment_command(update: Update, context: CallbackContext) -> None:  # pyli
     update_last_activity(update.effective_chat.id)
 
 
+def output_command(update: Update, context: CallbackContext) -> None:  # pylint: disable=unused-argument
+    """/output command"""
+    outputs_list = [[InlineKeyboardButton(text='Изображения', callback_data='output_photos'),
+                     InlineKeyboardButton(text='PDF', callback_data='output_pdf'),
+                     InlineKeyboardButton(text='Векторный PDF', callback_data='output_vector')
+                     ],
+                    ]
+    keyboard = InlineKeyboardMarkup(outputs_list)
+
+    update.message.reply_text('Выберите формат', reply_markup=keyboard)
+
+    update_last_activity(update.effective_chat.id)
+
+
 def color_command(update: Update, context: CallbackContext) -> None:  # pylint: disable=unused-argument
     """/color command"""
     update.message.reply_text('Выберите цвет текста. По-английски, по-русски или hex.\n'
@@ -246,15 +414,15 @@ def color_command(update: Update, context: CallbackContext) -> None:  # pylint:
 
 def color_input(update: Update, context: CallbackContext) -> int:  # pylint: disable=unused-argument
     """Process font color input"""
-    user_query = {'_id': update.effective_chat.id}
     try:
         parsed_color = text_to_rgb(update.message.text.strip())
-        configs_db.update_one(user_query, {'$set': {'font-color': parsed_color}})
+        set_user_config(update.effective_chat.id, {'font-color': parsed_color})
         update.message.reply_text(f'Цвет текста: {update.message.text.strip()}')
         update_last_activity(update.effective_chat.id)
         return ConversationHandler.END
     except ValueError as exception:
-        add_error(update.effective_chat.id, ET_UNKNOWN_COLOR, str(exception))
+        add_error(update.effective_chat.id, ET_UNKNOWN_COLOR, str(exception),
+                  normalize_color(update.message.text.strip()))
         update.message.reply_text('Не получилось распознать цвет, попробуй другой.\n\n'
                                   '/cancel для отмены.')
         update_last_activity(update.effective_chat.id)
@@ -273,21 +441,65 @@ def bgcolor_command(update: Update, context: CallbackContext) -> None:  # pylint
 
 def bgcolor_input(update: Update, context: CallbackContext) -> int:  # pylint: disable=unused-argument
     """Process background color input"""
-    user_query = {'_id': update.effective_chat.id}
     try:
         parsed_color = text_to_rgb(update.message.text.strip())
-        configs_db.update_one(user_query, {'$set': {'background-color': parsed_color}})
+        set_user_config(update.effective_chat.id, {'background-color': parsed_color, 'background': None})
         update.message.reply_text(f'Цвет фона: {update.message.text.strip()}')
         update_last_activity(update.effective_chat.id)
         return ConversationHandler.END
     except ValueError as exception:
-        add_error(update.effective_chat.id, ET_UNKNOWN_COLOR, str(exception))
+        add_error(update.effective_chat.id, ET_UNKNOWN_COLOR, str(exception),
+                  normalize_color(update.message.text.strip()))
+        update.message.reply_text('Не получилось распознать цвет, попробуй другой.\n\n'
+                                  '/cancel для отмены.')
+        update_last_activity(update.effective_chat.id)
+        return COLOR
+
+
+def gradient_command(update: Update, context: CallbackContext) -> None:  # pylint: disable=unused-argument
+    """/gradient command"""
+    update.message.reply_text('Выберите цвет низа фона, сверху будет цвет фона. По-английски, по-русски или hex.\n'
+                              'Например: navy, тёмно-синий, 000080, #000080\n\n'
+                              '/cancel для отмены.')
+
+    update_last_activity(update.effective_chat.id)
+    return COLOR
+
+
+def gradient_input(update: Update, context: CallbackContext) -> int:  # pylint: disable=unused-argument
+    """Process gradient color input"""
+    try:
+        parsed_color = text_to_rgb(update.message.text.strip())
+        set_user_config(update.effective_chat.id, {'background': {'type': 'gradient', 'color': parsed_color}})
+        update.message.reply_text(f'Градиент фона до цвета: {update.message.text.strip()}')
+        update_last_activity(update.effective_chat.id)
+        return ConversationHandler.END
+    except ValueError as exception:
+        add_error(update.effective_chat.id, ET_UNKNOWN_COLOR, str(exception),
+                  normalize_color(update.message.text.strip()))
         update.message.reply_text('Не получилось распознать цвет, попробуй другой.\n\n'
                                   '/cancel для отмены.')
         update_last_activity(update.effective_chat.id)
         return COLOR
 
 
+def photo_response(update: Update, context: CallbackContext) -> None:
+    """Set sent photo as the pages background"""
+    photo = update.message.photo[-1]
+    data = context.bot.get_file(photo.file_id).download_as_bytearray()
+    try:
+        file_name = store_background(bytes(data))
+    except BackgroundError as exception:
+        logger.info('Background upload rejected: %s', exception)
+        update.message.reply_text('Не получилось прочитать изображение, попробуй другое.')
+        return
+
+    set_user_config(update.effective_chat.id, {'background': {'type': 'image', 'file': file_name}})
+    update.message.reply_text('Фото установлено фоном. /bgcolor вернёт сплошной цвет.')
+
+    update_last_activity(update.effective_chat.id)
+
+
 def cancel(update: Update, context: CallbackContext) -> int:  # pylint: disable=unused-argument
     """Cancel command"""
     update.message.reply_text('Ок')
@@ -297,66 +509,372 @@ def cancel(update: Update, context: CallbackContext) -> int:  # pylint: disable=
 
 def reset_command(update: Update, context: CallbackContext) -> int:  # pylint: disable=unused-argument
     """Reset preferences command"""
-    user_query = {'_id': update.effective_chat.id}
-    default_user_config = {'font-family': DEFAULT_FONT_FAMILY,
-                           'font-size': DEFAULT_FONT_SIZE,
-                           'font-color': DEFAULT_FONT_COLOR,
-                           'background-color': DEFAULT_BACKGROUND_COLOR,
-                           'orientation': DEFAULT_ORIENTATION,
-                           'alignment': DEFAULT_ALIGNMENT}
-    configs_db.update_one(user_query, {'$set': default_user_config})
+    set_user_config(update.effective_chat.id, DEFAULT_DOCUMENT)
     update.message.reply_text('Установлены первоначальные параметры.')
     update_last_activity(update.effective_chat.id)
     return ConversationHandler.END
 
 
+def message_text(message):
+    """Plain text or styled runs of a text message"""
+    if message.entities:
+        return entities_to_runs(message.text, message.entities)
+    return message.text
+
+
+def render_message_text(user_config: UserConfig, text, rendered_hashes=()):
+    """Split text into pages and render the changed ones in the render workers, vector PDFs draw their own pages"""
+    return render_pool.render_text(user_config, text, rendered_hashes, render=not PdfReply.is_vector(user_config))
+
+
+def rendered_pages(user_config: UserConfig, parts, pages: dict) -> list:
+    """Images of all the pages, rendering the ones left out as unchanged"""
+    if PdfReply.is_vector(user_config):
+        return [None] * len(parts)
+    missing = [i for i in range(len(parts)) if i not in pages]
+    if missing:
+        pages = {**pages, **dict(zip(missing, render_pool.render_parts(user_config, [parts[i] for i in missing])))}
+    return [pages[i] for i in range(len(parts))]
+
+
+def reply_pages(message, user_config: UserConfig, parts, pages) -> list:
+    """Reply with album or PDF of the split text pages and their images, return ids of the sent messages"""
+    if user_config.output == 'photos':
+        return [sent.message_id for sent in message.reply_media_group([InputMediaPhoto(page) for page in pages])]
+
+    with PdfReply(user_config) as pdf_reply:
+        pdf_reply.add_pages(parts, pages)
+        return [pdf_reply.send(message).message_id]
+
+
 def response(update: Update, context: CallbackContext) -> None:  # pylint: disable=unused-argument
     """Response with images"""
-    user_config = configs_db.find_one({'_id': update.effective_chat.id})
-    if not user_config:
-        default_user_config = {'_id': update.effective_chat.id,
-                               'font-family': DEFAULT_FONT_FAMILY,
-                               'font-size': DEFAULT_FONT_SIZE,
-                               'font-color': DEFAULT_FONT_COLOR,
-                               'background-color': DEFAULT_BACKGROUND_COLOR,
-                               'orientation': DEFAULT_ORIENTATION,
-                               'alignment': DEFAULT_ALIGNMENT}
-        user_config = configs_db.find_one({'_id': configs_db.insert_one(default_user_config).inserted_id})
-
-    user_font = FONTS.get(user_config['font-family'], FONTS[DEFAULT_FONT_FAMILY])
-    font = ImageFont.truetype(str(Path('.') / 'fonts' / user_font), user_config['font-size'])
-
-    img_width, img_height = ORIENTATION.get(user_config['orientation'], 'square')
-    tti = TextToImages(img_width,
-                       img_height,
-                       font,
-                       tuple(user_config['background-color']),
-                       tuple(user_config['font-color']),
-                       user_config.get('alignment', DEFAULT_ALIGNMENT))
-
-    images = []
-    for part in range(len(tti.split_text(update.message.text, True))):
-        image = tti.render(update.message.text, True, part)
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, optimize=True, format='PNG')
-        img_byte_arr.seek(0)
-        images.append(InputMediaPhoto(img_byte_arr))
-
-    update.message.reply_media_group(images)
+    chat_id = update.effective_chat.id
+    user_config = get_user_config(chat_id)
+    parts, hashes, pages = render_message_text(user_config, message_text(update.message))
+
+    message_ids = reply_pages(update.message, user_config, parts, rendered_pages(user_config, parts, pages))
+    sent_renders[(chat_id, update.message.message_id)] = SentRender(user_config, hashes, message_ids)
+    record_render(stats_db, len(parts), datetime.utcnow())
+
+    update_last_activity(chat_id)
+
+
+def edit_album(bot, message, user_config: UserConfig, parts, hashes, pages: dict,  # pylint: disable=too-many-arguments
+               previous: SentRender) -> list:
+    """Replace changed pages of the sent album, send added pages and delete removed ones, `pages` has their images"""
+    kept = min(len(parts), len(previous.message_ids))
+    changed = [i for i in range(kept) if user_config != previous.config or hashes[i] != previous.page_hashes[i]]
+
+    for i in changed:
+        bot.edit_message_media(chat_id=message.chat_id,
+                               message_id=previous.message_ids[i],
+                               media=InputMediaPhoto(pages[i]))
+
+    message_ids = previous.message_ids[:kept]
+    if len(parts) > kept:
+        message_ids += reply_pages(message, user_config, parts[kept:], [pages[i] for i in range(kept, len(parts))])
+    for message_id in previous.message_ids[kept:]:
+        bot.delete_message(message.chat_id, message_id)
+    return message_ids
+
+
+def edited_response(update: Update, context: CallbackContext) -> None:
+    """Update the response to an edited message, re-rendering only the changed pages"""
+    chat_id = update.effective_chat.id
+    message = update.edited_message
+    user_config = get_user_config(chat_id)
+    previous = sent_renders.get((chat_id, message.message_id))
+    rendered_hashes = ()
+    if previous and previous.config == user_config and user_config.output == 'photos':
+        # Only the album pages which changed are edited
+        rendered_hashes = previous.page_hashes
+    parts, hashes, pages = render_message_text(user_config, message_text(message), rendered_hashes)
+
+    if previous and previous.config == user_config and previous.page_hashes == hashes:
+        # Edits of the text which don't change the pages, e.g. in typography
+        return
+
+    try:
+        if not previous or previous.config.output != user_config.output:
+            message_ids = reply_pages(message, user_config, parts, rendered_pages(user_config, parts, pages))
+        elif user_config.output == 'photos':
+            message_ids = edit_album(context.bot, message, user_config, parts, hashes, pages, previous)
+        else:
+            with PdfReply(user_config) as pdf_reply:
+                pdf_reply.add_pages(parts, rendered_pages(user_config, parts, pages))
+                pdf_reply.edit(context.bot, chat_id, previous.message_ids[0])
+            message_ids = previous.message_ids
+    except BadRequest as exception:
+        # Replies may be deleted by the user or too old to be edited
+        logger.info('Response to the edited message %s not edited: %s', message.message_id, exception)
+        message_ids = reply_pages(message, user_config, parts, rendered_pages(user_config, parts, pages))
+
+    sent_renders[(chat_id, message.message_id)] = SentRender(user_config, hashes, message_ids)
+    record_render(stats_db, len(parts), datetime.utcnow())
+
+    update_last_activity(chat_id)
+
+
+class PdfReply:
+    """Pages written to a single PDF document as they are rendered"""
+
+    def __init__(self, user_config: UserConfig):
+        self.user_config = user_config
+        self._file = tempfile.TemporaryFile()
+        if self.is_vector(user_config):
+            self._writer = VectorPdfWriter(self._file,
+                                           create_renderer(user_config),
+                                           {**font_files(user_config.font_family),
+                                            **fallback_files(user_config.font_family)})
+        else:
+            self._writer = RasterPdfWriter(self._file)
+
+    @staticmethod
+    def is_vector(user_config: UserConfig) -> bool:
+        """Whether pages are drawn as text instead of images"""
+        # Only TrueType outlines can be embedded, uploaded OpenType fonts with CFF outlines are drawn as images
+        return user_config.output == 'vector-pdf' and not user_config.font_family.endswith('.otf')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+    def add_parts(self, parts):
+        """Add pages with split text parts"""
+        if isinstance(self._writer, VectorPdfWriter):
+            for part in parts:
+                self._writer.add_page(part)
+        else:
+            for page in render_pool.render_parts(self.user_config, parts):
+                self._writer.add_page(Image.open(page))
+
+    def add_pages(self, parts, pages):
+        """Add split text pages, drawn from the parts or from their rendered images"""
+        if isinstance(self._writer, VectorPdfWriter):
+            for part in parts:
+                self._writer.add_page(part)
+        else:
+            for page in pages:
+                self._writer.add_page(Image.open(page))
+
+    def send(self, message):
+        """Finish the document and send it as a reply"""
+        self._writer.close()
+        self._file.seek(0)
+        return message.reply_document(self._file, filename='text.pdf')
+
+    def edit(self, bot, chat_id: int, message_id: int):
+        """Finish the document and put it in place of the one sent before"""
+        self._writer.close()
+        self._file.seek(0)
+        bot.edit_message_media(chat_id=chat_id,
+                               message_id=message_id,
+                               media=InputMediaDocument(self._file, filename='text.pdf'))
+
+
+def reply_album(message, pages):
+    """Send pages as album, waiting out flood limits"""
+    images = [InputMediaPhoto(page) for page in pages]
+    while True:
+        try:
+            message.reply_media_group(images)
+            return
+        except RetryAfter as exception:
+            time.sleep(exception.retry_after)
+
+
+def document_cancel_keyboard() -> InlineKeyboardMarkup:
+    """Keyboard to cancel text document processing"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text='Отменить', callback_data='job_cancel')]])
+
+
+def document_response(update: Update, context: CallbackContext) -> None:
+    """Response to a text document with albums of images"""
+    chat_id = update.effective_chat.id
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_DOCUMENT_SIZE:
+        update.message.reply_text('Файл слишком большой.')
+        return
+
+    pages_left = document_pages_left(chat_id)
+    if pages_left <= 0:
+        update.message.reply_text(f'Из файлов можно получить не больше {MAX_DOCUMENT_PAGES} страниц в сутки. '
+                                  'Попробуйте позже.')
+        return
+
+    cancelled = Event()
+    with document_jobs_lock:
+        if chat_id in document_jobs:
+            update.message.reply_text('Предыдущий файл ещё обрабатывается.')
+            return
+        document_jobs[chat_id] = cancelled
+
+    try:
+        user_config = get_user_config(chat_id)
+        status = update.message.reply_text('Обработано страниц: 0', reply_markup=document_cancel_keyboard())
+        pages_count = 0
+        limit_reached = False
+
+        with tempfile.TemporaryFile() as document_file, ExitStack() as stack:
+            context.bot.get_file(document.file_id).download(out=document_file)
+            document_file.seek(0)
+
+            pdf_reply = None
+            if user_config.output != 'photos':
+                pdf_reply = stack.enter_context(PdfReply(user_config))
+
+            album = []
+            # Only one album of split lines is kept in memory
+            for part in create_renderer(user_config).iter_parts(iter_document_lines(document_file)):
+                if cancelled.is_set():
+                    break
+                if not part:
+                    continue
+                if pages_count + len(album) == pages_left:
+                    limit_reached = True
+                    break
+
+                album.append(part)
+                if len(album) == ALBUM_SIZE:
+                    if pdf_reply:
+                        pdf_reply.add_parts(album)
+                    else:
+                        reply_album(update.message, render_pool.render_parts(user_config, album))
+                        count_document_pages(chat_id, len(album))
+                    pages_count += len(album)
+                    album = []
+                    status.edit_text(f'Обработано страниц: {pages_count}', reply_markup=document_cancel_keyboard())
+
+            if album and not cancelled.is_set():
+                if pdf_reply:
+                    pdf_reply.add_parts(album)
+                else:
+                    reply_album(update.message, render_pool.render_parts(user_config, album))
+                    count_document_pages(chat_id, len(album))
+                pages_count += len(album)
+
+            if pdf_reply and pages_count and not cancelled.is_set():
+                pdf_reply.send(update.message)
+                count_document_pages(chat_id, pages_count)
+
+        if cancelled.is_set():
+            status.edit_text(f'Отменено. Отправлено страниц: {pages_count}')
+        elif limit_reached:
+            status.edit_text(f'Отправлено первых страниц: {pages_count}. '
+                             f'Из файлов можно получить не больше {MAX_DOCUMENT_PAGES} страниц в сутки.')
+        else:
+            status.edit_text(f'Готово. Отправлено страниц: {pages_count}')
+        if pages_count:
+            record_render(stats_db, pages_count, datetime.utcnow())
+    finally:
+        with document_jobs_lock:
+            del document_jobs[chat_id]
+
+    update_last_activity(chat_id)
+
+
+def font_document_response(update: Update, context: CallbackContext) -> None:
+    """Set uploaded font file as the user font"""
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_FONT_FILE_SIZE:
+        update.message.reply_text('Файл шрифта слишком большой.')
+        return
+
+    data = context.bot.get_file(document.file_id).download_as_bytearray()
+    try:
+        font_family, font_name = store_font(bytes(data))
+    except FontError as exception:
+        logger.info('Font upload rejected: %s', exception)
+        update.message.reply_text('Не получилось прочитать шрифт. Пришлите файл TTF или OTF.')
+        return
+
+    set_user_config(update.effective_chat.id, {'font-family': font_family})
+    update.message.reply_text(f'Выбранный шрифт: {font_name}')
+
     update_last_activity(update.effective_chat.id)
 
 
-def main() -> None:
-    """Main Telegram Bot function"""
-    updater = Updater(TELEGRAM_BOT_TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
+def inline_result_id(user_config: UserConfig, text: str) -> str:
+    """Hash of the inline query text and render parameters"""
+    return hashlib.sha1(f'{user_config!r}\n{text}'.encode()).hexdigest()
+
+
+def inline_keyboard() -> InlineKeyboardMarkup:
+    """Keyboard attached to inline results, without it chosen results have no inline_message_id"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text='Text2Image', switch_inline_query_current_chat='')]])
 
+
+def inline_query(update: Update, context: CallbackContext) -> None:
+    """Answer inline query with a preview of the first image"""
+    query = update.inline_query
+    text = query.query.strip()
+    if not text or not inline_debouncer.settle(query.from_user.id, query.id):
+        return
+
+    user_config = get_user_config(query.from_user.id)
+    result_id = inline_result_id(user_config, text)
+    preview_id = inline_previews.get(result_id)
+    if preview_id is None:
+        preview = render_pool.render_first_page(user_config, text, INLINE_THUMB_SCALE)
+        message = context.bot.send_photo(INLINE_CACHE_CHAT_ID, preview, disable_notification=True)
+        preview_id = message.photo[-1].file_id
+        inline_previews[result_id] = preview_id
+
+    query.answer([InlineQueryResultCachedPhoto(id=result_id, photo_file_id=preview_id, reply_markup=inline_keyboard())],
+                 cache_time=0,
+                 is_personal=True)
+
+
+def chosen_inline_result(update: Update, context: CallbackContext) -> None:
+    """Replace sent preview with the full-size image"""
+    result = update.chosen_inline_result
+    if not result.inline_message_id:
+        return
+
+    user_config = get_user_config(result.from_user.id)
+    image = render_pool.render_first_page(user_config, result.query.strip())
+    message = context.bot.send_photo(INLINE_CACHE_CHAT_ID, image, disable_notification=True)
+    context.bot.edit_message_media(inline_message_id=result.inline_message_id,
+                                   media=InputMediaPhoto(message.photo[-1].file_id),
+                                   reply_markup=inline_keyboard())
+    record_render(stats_db, 1, datetime.utcnow())
+    update_last_activity(result.from_user.id)
+
+
+def create_persistence() -> MongoPersistence:
+    """Conversation states storage"""
+    return MongoPersistence(db.conversations)
+
+
+def start_render_pool() -> None:
+    """Start render workers of this process"""
+    global render_pool  # pylint: disable=global-statement
+    render_pool = RenderPool(RENDER_WORKERS)
+
+
+def stop_render_pool() -> None:
+    """Stop render workers of this process"""
+    render_pool.shutdown()
+
+
+def setup_bot_worker(dispatcher: Dispatcher) -> None:
+    """Prepare bot worker process to handle updates"""
+    start_render_pool()
+    register_handlers(dispatcher)
+
+
+def register_handlers(dispatcher: Dispatcher) -> None:
+    """Add bot handlers to dispatcher"""
     dispatcher.add_handler(CommandHandler('start', start))
     dispatcher.add_handler(CommandHandler('help', help_command))
     dispatcher.add_handler(CommandHandler('font', font_command))
     dispatcher.add_handler(CommandHandler('size', size_command))
     dispatcher.add_handler(CommandHandler('orientation', orientation_command))
     dispatcher.add_handler(CommandHandler('alignment', alignment_command))
+    dispatcher.add_handler(CommandHandler('output', output_command))
     dispatcher.add_handler(CommandHandler('reset', reset_command))
 
     color_conv_handler = ConversationHandler(
@@ -365,6 +883,8 @@ def main() -> None:
             COLOR: [MessageHandler(Filters.text & ~Filters.command, color_input)]
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='color',
+        persistent=True,
     )
     dispatcher.add_handler(color_conv_handler)
 
@@ -374,18 +894,76 @@ def main() -> None:
             COLOR: [MessageHandler(Filters.text & ~Filters.command, bgcolor_input)]
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='bgcolor',
+        persistent=True,
     )
     dispatcher.add_handler(bg_color_conv_handler)
 
-    response_handler = MessageHandler(Filters.text & (~Filters.command), response)
+    gradient_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('gradient', gradient_command)],
+        states={
+            COLOR: [MessageHandler(Filters.text & ~Filters.command, gradient_input)]
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='gradient',
+        persistent=True,
+    )
+    dispatcher.add_handler(gradient_conv_handler)
+
+    response_handler = MessageHandler(Filters.update.message & Filters.text & (~Filters.command),
+                                      response,
+                                      run_async=bool(RENDER_WORKERS))
     dispatcher.add_handler(response_handler)
+    edited_handler = MessageHandler(Filters.update.edited_message & Filters.text & (~Filters.command),
+                                    edited_response,
+                                    run_async=bool(RENDER_WORKERS))
+    dispatcher.add_handler(edited_handler)
 
-    updater.dispatcher.add_handler(CallbackQueryHandler(button))
+    dispatcher.add_handler(MessageHandler(Filters.document.mime_type('text/plain'), document_response, run_async=True))
+    font_filter = Filters.document.file_extension('ttf') | Filters.document.file_extension('otf')
+    dispatcher.add_handler(MessageHandler(font_filter, font_document_response, run_async=True))
+    dispatcher.add_handler(MessageHandler(Filters.photo, photo_response, run_async=True))
+
+    dispatcher.add_handler(CallbackQueryHandler(button))
+
+    dispatcher.add_handler(InlineQueryHandler(inline_query, run_async=True))
+    dispatcher.add_handler(ChosenInlineResultHandler(chosen_inline_result, run_async=True))
+
+
+def main() -> None:
+    """Main Telegram Bot function"""
+    # Handlers only wait for render workers, so let them wait concurrently
+    dispatcher_workers = max(4, 2 * RENDER_WORKERS)
+    create_error_events()
+
+    fanout = None
+    if BOT_WORKERS:
+        # Conversation states are kept by the workers
+        updater = Updater(TELEGRAM_BOT_TOKEN, use_context=True)
+        # Only the workers render, each with its own render processes
+        fanout = FanOut(TELEGRAM_BOT_TOKEN, BOT_WORKERS, setup_bot_worker, create_persistence, dispatcher_workers,
+                        teardown=stop_render_pool)
+        fanout.start()
+        updater.dispatcher.add_handler(TypeHandler(Update, fanout.forward))
+    else:
+        updater = Updater(TELEGRAM_BOT_TOKEN,
+                          use_context=True,
+                          workers=dispatcher_workers,
+                          persistence=create_persistence())
+        start_render_pool()
+        register_handlers(updater.dispatcher)
 
     updater.start_polling()
 
     updater.idle()
 
+    if fanout:
+        fanout.stop()
+    else:
+        # Write states changed while the updater was stopping
+        updater.persistence.flush()
+        stop_render_pool()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,64 @@
+"""
+In-memory caches
+"""
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """
+    Thread-safe mapping which keeps only the most recently used items.
+
+    Items have size 1 unless put with another one, the total size is kept within `maxsize`.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.currsize = 0
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Get item and mark it as recently used"""
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def put(self, key, value, size: int = 1):
+        """Add item of the size, evicting the least recently used ones"""
+        with self._lock:
+            self.currsize += size - self._sizes.get(key, 0)
+            self._items[key] = value
+            self._sizes[key] = size
+            self._items.move_to_end(key)
+            # The newest item is kept even if it doesn't fit alone
+            while self.currsize > self.maxsize and len(self._items) > 1:
+                evicted, _ = self._items.popitem(last=False)
+                self.currsize -= self._sizes.pop(evicted)
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def pop(self, key, default=None):
+        """Remove item"""
+        with self._lock:
+            self.currsize -= self._sizes.pop(key, 0)
+            return self._items.pop(key, default)
+
+    def clear(self):
+        """Remove all items"""
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.currsize = 0
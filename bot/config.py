@@ -0,0 +1,166 @@
+"""
+User render parameters
+"""
+from dataclasses import dataclass
+from pathlib import Path
+
+from custom_fonts import custom_font_file
+from rendering import DEFAULT_FONT_FAMILY, DEFAULT_FONT_SIZE, DEFAULT_FONT_COLOR, DEFAULT_BACKGROUND_COLOR, \
+    DEFAULT_ORIENTATION, DEFAULT_ALIGNMENT, DEFAULT_OUTPUT, FONTS, ORIENTATION, get_fonts
+from text_to_image import StyledFonts
+
+MIN_FONT_SIZE = 10
+MAX_FONT_SIZE = 100
+
+ALIGNMENTS = ('left', 'center', 'right', 'justify')
+OUTPUTS = ('photos', 'pdf', 'vector-pdf')
+
+
+def pack_color(color) -> int:
+    """RGB color as a single 0xRRGGBB integer"""
+    red, green, blue = color
+    return (red << 16) | (green << 8) | blue
+
+
+def unpack_color(value: int) -> tuple:
+    """RGB tuple from a 0xRRGGBB integer"""
+    return (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF
+
+
+# Config fields in the stored form, fields equal to these are not stored
+DEFAULT_DOCUMENT = {'font-family': DEFAULT_FONT_FAMILY,
+                    'font-size': DEFAULT_FONT_SIZE,
+                    'font-color': pack_color(DEFAULT_FONT_COLOR),
+                    'background-color': pack_color(DEFAULT_BACKGROUND_COLOR),
+                    'background': None,
+                    'orientation': DEFAULT_ORIENTATION,
+                    'alignment': DEFAULT_ALIGNMENT,
+                    'output': DEFAULT_OUTPUT}
+COLOR_FIELDS = ('font-color', 'background-color')
+
+
+def _compact_value(key: str, value):
+    """Stored form of a config field value"""
+    if key in COLOR_FIELDS and isinstance(value, (list, tuple)):
+        return pack_color(value)
+    if key == 'background' and isinstance(value, dict) and isinstance(value.get('color'), (list, tuple)):
+        return {**value, 'color': pack_color(value['color'])}
+    return value
+
+
+def compact_update(fields: dict) -> dict:
+    """MongoDB update setting config fields in the compact form: colors packed, default values removed"""
+    set_fields = {}
+    unset_fields = {}
+    for key, value in fields.items():
+        value = _compact_value(key, value)
+        if key in DEFAULT_DOCUMENT and value == DEFAULT_DOCUMENT[key]:
+            unset_fields[key] = ''
+        else:
+            set_fields[key] = value
+
+    update = {}
+    if set_fields:
+        update['$set'] = set_fields
+    if unset_fields:
+        update['$unset'] = unset_fields
+    return update
+
+
+def _parse_color(value, default):
+    """RGB tuple from a stored color, packed or an array of channels, default one if it is malformed"""
+    if isinstance(value, int):
+        return unpack_color(value) if 0 <= value <= 0xFFFFFF else default
+    try:
+        color = tuple(int(channel) for channel in value)
+    except (TypeError, ValueError):
+        return default
+    if len(color) != 3 or not all(0 <= channel <= 255 for channel in color):
+        return default
+    return color
+
+
+def _parse_background(value, background_color):
+    """Background key from a stored background, None for a flat background color"""
+    if not isinstance(value, dict):
+        return None
+    if value.get('type') == 'gradient':
+        color = _parse_color(value.get('color'), None)
+        return ('gradient', background_color, color) if color else None
+    if value.get('type') == 'image' and isinstance(value.get('file'), str):
+        # File name must not point outside of the backgrounds directory
+        return 'image', Path(value['file']).name
+    return None
+
+
+@dataclass(frozen=True)
+class UserConfig:
+    """
+    Render parameters of a user, validated once when loaded from MongoDB.
+
+    Documents are read in both the compact form and the old one, with all the fields and array colors.
+
+    Instances are immutable and hashable, so they are cache keys themselves.
+    """
+
+    __slots__ = ('font_family', 'font_size', 'font_color', 'background_color', 'background', 'orientation',
+                 'alignment', 'output', 'page_size')
+
+    font_family: str
+    font_size: int
+    font_color: tuple
+    background_color: tuple
+    # Background key, None for a flat background color
+    background: tuple
+    orientation: str
+    alignment: str
+    output: str
+    # Full-size image width and height
+    page_size: tuple
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'UserConfig':
+        """Parse config document, replacing missing and unknown values with the default ones"""
+        font_family = document.get('font-family')
+        if font_family not in FONTS and not (isinstance(font_family, str) and custom_font_file(font_family)):
+            font_family = DEFAULT_FONT_FAMILY
+
+        font_size = document.get('font-size')
+        if not isinstance(font_size, int) or not MIN_FONT_SIZE <= font_size <= MAX_FONT_SIZE:
+            font_size = DEFAULT_FONT_SIZE
+
+        orientation = document.get('orientation')
+        if orientation not in ORIENTATION:
+            orientation = DEFAULT_ORIENTATION
+
+        alignment = document.get('alignment')
+        if alignment not in ALIGNMENTS:
+            alignment = DEFAULT_ALIGNMENT
+
+        output = document.get('output')
+        if output not in OUTPUTS:
+            output = DEFAULT_OUTPUT
+
+        background_color = _parse_color(document.get('background-color'), DEFAULT_BACKGROUND_COLOR)
+        return cls(font_family=font_family,
+                   font_size=font_size,
+                   font_color=_parse_color(document.get('font-color'), DEFAULT_FONT_COLOR),
+                   background_color=background_color,
+                   background=_parse_background(document.get('background'), background_color),
+                   orientation=orientation,
+                   alignment=alignment,
+                   output=output,
+                   page_size=ORIENTATION[orientation])
+
+    @property
+    def fonts(self) -> StyledFonts:
+        """Fonts of the family and size, loaded once per process"""
+        return get_fonts(self.font_family, self.font_size)
+
+    # Frozen instances with slots can't be unpickled by assigning the attributes one by one
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
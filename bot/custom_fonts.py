@@ -0,0 +1,85 @@
+"""
+User uploaded fonts
+"""
+import hashlib
+import io
+import os
+import tempfile
+from pathlib import Path
+
+from fontTools.ttLib import TTFont
+from PIL import ImageFont
+
+CUSTOM_FONTS_DIR = Path('.') / 'custom-fonts'
+# Font families of uploaded fonts are this prefix and the font file name
+CUSTOM_FONT_PREFIX = 'custom:'
+
+MAX_FONT_FILE_SIZE = 5 * 1024 * 1024
+
+REQUIRED_TABLES = {'cmap', 'head', 'hhea', 'hmtx', 'maxp', 'name', 'post'}
+# Tables used for drawing, the rest, like signatures and color or variation data, are dropped
+KEPT_TABLES = REQUIRED_TABLES | {'OS/2', 'glyf', 'loca', 'CFF ', 'cvt ', 'fpgm', 'prep', 'gasp',
+                                 'kern', 'GDEF', 'GPOS', 'GSUB', 'vhea', 'vmtx'}
+
+
+class FontError(Exception):
+    """Uploaded file is not a usable font"""
+
+
+def _check_tables(font: TTFont):
+    missing = REQUIRED_TABLES - set(font.keys())
+    if missing:
+        raise FontError(f'font has no tables {", ".join(sorted(missing))}')
+    if 'glyf' not in font and 'CFF ' not in font:
+        raise FontError('font has no outlines')
+    if not font.getBestCmap():
+        raise FontError('font has no Unicode characters')
+
+
+def sanitize_font(data: bytes):
+    """Validate font and rebuild it with the drawing tables only, return font file bytes, name and suffix"""
+    if len(data) > MAX_FONT_FILE_SIZE:
+        raise FontError('font file is too big')
+
+    try:
+        # Keep the modification date, so that the same upload gives the same bytes
+        font = TTFont(io.BytesIO(data), recalcTimestamp=False)
+        _check_tables(font)
+        for tag in set(font.keys()) - KEPT_TABLES - {'GlyphOrder'}:
+            del font[tag]
+        name = font['name'].getDebugName(4) or font['name'].getDebugName(1) or 'Custom'
+        suffix = '.otf' if 'CFF ' in font else '.ttf'
+        output = io.BytesIO()
+        font.save(output)
+        sanitized = output.getvalue()
+        # FreeType has to load what fontTools wrote
+        ImageFont.truetype(io.BytesIO(sanitized), 40).getsize('W')
+    except FontError:
+        raise
+    except Exception as exception:  # pylint: disable=broad-except
+        # Malformed fonts make parsers fail in all the ways
+        raise FontError(f'font can not be read: {exception}') from exception
+    return sanitized, name, suffix
+
+
+def store_font(data: bytes):
+    """Sanitize font and save it once per content, return its font family and name"""
+    sanitized, name, suffix = sanitize_font(data)
+    file_name = hashlib.sha256(sanitized).hexdigest() + suffix
+    path = CUSTOM_FONTS_DIR / file_name
+    if not path.exists():
+        CUSTOM_FONTS_DIR.mkdir(parents=True, exist_ok=True)
+        # Render workers never see a partially written file
+        with tempfile.NamedTemporaryFile(dir=CUSTOM_FONTS_DIR, delete=False) as temporary:
+            temporary.write(sanitized)
+        os.replace(temporary.name, path)
+    return CUSTOM_FONT_PREFIX + file_name, name
+
+
+def custom_font_file(font_family: str):
+    """Stored file of an uploaded font family, None for other families and missing files"""
+    if not font_family.startswith(CUSTOM_FONT_PREFIX):
+        return None
+    # Family comes from the user config, it must not point outside of the fonts directory
+    path = CUSTOM_FONTS_DIR / Path(font_family[len(CUSTOM_FONT_PREFIX):]).name
+    return path if path.is_file() else None
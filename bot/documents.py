@@ -0,0 +1,32 @@
+"""
+Text documents reading
+"""
+import codecs
+import io
+
+from typus import ru_typus
+
+# Bytes to look at when guessing document encoding
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+
+def guess_encoding(document) -> str:
+    """UTF-8 if the beginning of the document decodes as UTF-8, Windows-1251 otherwise"""
+    sample = document.read(ENCODING_SAMPLE_SIZE)
+    document.seek(0)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError as exception:
+        # Sample may end in the middle of a multibyte character
+        if exception.start < len(sample) - 3:
+            return 'cp1251'
+    return 'utf-8'
+
+
+def iter_document_lines(document, typo: bool = True):
+    """Decode binary document line by line"""
+    for line in io.TextIOWrapper(document, encoding=guess_encoding(document), errors='replace'):
+        line = line.rstrip('\r\n')
+        yield ru_typus(line) if typo else line
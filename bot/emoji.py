@@ -0,0 +1,86 @@
+"""
+Color emoji drawing
+"""
+import re
+from threading import Lock
+
+from PIL import Image, ImageDraw, ImageFont, features
+
+from cache import LRUCache
+
+# Noto Color Emoji has bitmaps of this size only, they are scaled to the text size
+EMOJI_FONT_SIZE = 109
+
+_VS16 = '\uFE0F'
+_ZWJ = '\u200D'
+_EMOJI_BASE = ('[\U0001F000-\U0001FAFF]'
+               # Emoji presentation characters of the older blocks
+               '|[\u231A\u231B\u23E9-\u23EC\u23F0\u23F3\u25FD\u25FE\u2614\u2615\u2648-\u2653\u267F\u2693\u26A1'
+               '\u26AA\u26AB\u26BD\u26BE\u26C4\u26C5\u26CE\u26D4\u26EA\u26F2\u26F3\u26F5\u26FA\u26FD\u2705\u270A'
+               '\u270B\u2728\u274C\u274E\u2753-\u2755\u2757\u2795-\u2797\u27B0\u27BF\u2B1B\u2B1C\u2B50\u2B55]'
+               # Text presentation characters turned to emoji by the variation selector
+               '|[\u00A9\u00AE\u203C\u2049\u2122\u2139\u2194-\u21AA\u2300-\u23FF\u24C2\u25AA-\u25FE\u2600-\u27BF'
+               '\u2934\u2935\u2B05-\u2B55\u3030\u303D\u3297\u3299]' + _VS16)
+# Variation selector, skin tones, keycap and tags of subdivision flags
+_EMOJI_MODIFIERS = '[\uFE0F\U0001F3FB-\U0001F3FF\u20E3]*[\U000E0020-\U000E007F]*'
+
+# Flags, keycaps and ZWJ sequences of emoji with skin tones and other modifiers
+EMOJI_SEQUENCE = re.compile('[\U0001F1E6-\U0001F1FF]{2}'
+                            '|[0-9#*]\uFE0F?\u20E3'
+                            f'|(?:{_EMOJI_BASE}){_EMOJI_MODIFIERS}(?:{_ZWJ}(?:{_EMOJI_BASE}|.){_EMOJI_MODIFIERS})*')
+
+
+def split_emoji(text: str):
+    """Split text into pieces of plain text and single emoji sequences, yield whether a piece is emoji and it"""
+    start = 0
+    for match in EMOJI_SEQUENCE.finditer(text):
+        if match.start() > start:
+            yield False, text[start:match.start()]
+        yield True, match.group()
+        start = match.end()
+    if start < len(text):
+        yield False, text[start:]
+
+
+class EmojiAtlas:
+    """
+    Emoji images rasterized once per text size.
+
+    Sequences are shaped into single glyphs when Pillow is built with Raqm,
+    otherwise their parts are drawn one by one.
+    """
+
+    def __init__(self, font_path: str, maxsize: int):
+        self.font_path = font_path
+        self._font = None
+        self._font_lock = Lock()
+        self._images = LRUCache(maxsize)
+
+    def _get_font(self):
+        with self._font_lock:
+            if self._font is None:
+                layout_engine = ImageFont.LAYOUT_RAQM if features.check('raqm') else ImageFont.LAYOUT_BASIC
+                self._font = ImageFont.truetype(self.font_path, EMOJI_FONT_SIZE, layout_engine=layout_engine)
+            return self._font
+
+    def get(self, sequence: str, size: int):
+        """RGBA image of the emoji sequence for the text size"""
+        key = (sequence, size)
+        image = self._images.get(key)
+        if image is None:
+            font = self._get_font()
+            width, height = font.getsize(sequence)
+            image = Image.new('RGBA', (width, height))
+            ImageDraw.Draw(image).text((0, 0), sequence, font=font, fill='black', embedded_color=True)
+            scale = size / EMOJI_FONT_SIZE
+            image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+            self._images[key] = image
+        return image
+
+    def ascent(self, size: int) -> int:
+        """Height of emoji images above the baseline for the text size"""
+        return round(self._get_font().getmetrics()[0] * size / EMOJI_FONT_SIZE)
+
+    def width(self, sequence: str, size: int) -> int:
+        """Advance of the emoji sequence for the text size"""
+        return self.get(sequence, size).size[0]
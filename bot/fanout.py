@@ -0,0 +1,208 @@
+"""
+Chat-partitioned bot workers
+"""
+import hashlib
+import logging
+import signal
+import sys
+import time
+from multiprocessing import get_context
+from queue import Empty, Queue
+from threading import Event, Thread
+
+from telegram import Bot, Update
+from telegram.ext import CallbackContext, Dispatcher
+
+# Seconds to wait before a replacement of a dead worker joins
+WORKER_RESTART_DELAY = 5
+# Seconds to wait for workers to write the states of the chats they give away before the chats move
+REBALANCE_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+def _release_moved_chats(dispatcher: Dispatcher, worker_id: int, worker_ids):
+    """Write conversation states and forget the ones of the chats routed to other workers now"""
+    # Updates queued before the routing changed may still change the states
+    dispatcher.update_queue.join()
+    if not dispatcher.persistence:
+        return
+    router = ChatRouter()
+    for other_id in worker_ids:
+        router.add(other_id)
+    # Conversations are per chat, the chat id comes first in their keys
+    dispatcher.persistence.release_conversations(lambda key: router.route(key[0]) == worker_id)
+
+
+def _worker_main(worker_id: int, token: str, updates, acks, setup, create_persistence,  # pylint: disable=too-many-arguments
+                 dispatcher_workers: int, teardown):
+    """Process updates of the chats routed to this worker in the order they come"""
+    # Ingress process decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    bot = Bot(token)
+    dispatcher = Dispatcher(bot,
+                            Queue(),
+                            workers=dispatcher_workers,
+                            use_context=True,
+                            persistence=create_persistence())
+    setup(dispatcher)
+
+    # Dispatcher thread starts the threads run_async handlers are run by
+    ready = Event()
+    dispatcher_thread = Thread(target=dispatcher.start, kwargs={'ready': ready}, name='dispatcher')
+    dispatcher_thread.start()
+    while not ready.wait(1):
+        if not dispatcher_thread.is_alive():
+            # Failed to start, e.g. getMe could not reach Telegram, the worker is restarted after a delay
+            sys.exit(1)
+
+    for message in iter(updates.get, None):
+        if isinstance(message, dict):
+            dispatcher.update_queue.put(Update.de_json(message, bot))
+        else:
+            generation, worker_ids = message
+            _release_moved_chats(dispatcher, worker_id, worker_ids)
+            acks.put((worker_id, generation))
+
+    # Queued updates and run_async handlers are finished first
+    dispatcher.stop()
+    dispatcher_thread.join()
+    if dispatcher.persistence:
+        dispatcher.persistence.flush()
+    # Exiting process doesn't run atexit handlers, resources of the setup are released here
+    if teardown:
+        teardown()
+
+
+class ChatRouter:
+    """Rendezvous hashing of chats to workers, so that only the chats of a joined or left worker move"""
+
+    def __init__(self):
+        self.workers = set()
+
+    @staticmethod
+    def _weight(worker_id: int, chat_id: int) -> int:
+        return int.from_bytes(hashlib.blake2b(f'{worker_id}:{chat_id}'.encode(), digest_size=8).digest(), 'big')
+
+    def add(self, worker_id: int):
+        """Worker joined"""
+        self.workers.add(worker_id)
+
+    def remove(self, worker_id: int):
+        """Worker left"""
+        self.workers.discard(worker_id)
+
+    def route(self, chat_id: int) -> int:
+        """Worker owning the chat"""
+        return max(self.workers, key=lambda worker_id: self._weight(worker_id, chat_id))
+
+
+class FanOut:
+    """
+    Distribute updates to worker processes by chat.
+
+    All updates of a chat go to the same worker and are processed there in order,
+    so conversation states stay local to the worker. States are persisted, so chats
+    moved to another worker pick them up from MongoDB on first access. Before chats
+    move, the workers write their states and forget the ones they give away.
+    """
+
+    def __init__(self, token: str, workers: int, setup, create_persistence,  # pylint: disable=too-many-arguments
+                 dispatcher_workers: int = 4, teardown=None):
+        self.token = token
+        self.workers = workers
+        self.setup = setup
+        self.create_persistence = create_persistence
+        self.dispatcher_workers = dispatcher_workers
+        self.teardown = teardown
+        self._context = get_context('spawn')
+        self._router = ChatRouter()
+        self._processes = {}
+        self._queues = {}
+        self._restart_at = {}
+        self._acks = self._context.Queue()
+        self._generation = 0
+
+    def _spawn(self, worker_id: int):
+        """Start worker and let it join the routing"""
+        updates = self._context.Queue()
+        process = self._context.Process(target=_worker_main,
+                                        args=(worker_id,
+                                              self.token,
+                                              updates,
+                                              self._acks,
+                                              self.setup,
+                                              self.create_persistence,
+                                              self.dispatcher_workers,
+                                              self.teardown),
+                                        name=f'bot-worker-{worker_id}')
+        process.start()
+        self._queues[worker_id] = updates
+        self._processes[worker_id] = process
+        self._router.add(worker_id)
+        logger.info('Bot worker %s joined, pid %s', worker_id, process.pid)
+
+    def _rebalance(self, joined):
+        """Let the other workers write the states of the chats moving to the joined ones and forget them"""
+        self._generation += 1
+        waiting = self._router.workers - joined
+        for worker_id in waiting:
+            self._queues[worker_id].put((self._generation, sorted(self._router.workers)))
+
+        deadline = time.monotonic() + REBALANCE_TIMEOUT
+        while waiting and time.monotonic() < deadline:
+            try:
+                worker_id, generation = self._acks.get(timeout=max(deadline - time.monotonic(), 0))
+            except Empty:
+                break
+            if generation == self._generation:
+                waiting.discard(worker_id)
+        if waiting:
+            logger.warning('Bot workers %s did not write conversation states in time', sorted(waiting))
+
+    def _check_workers(self):
+        """Move chats of dead workers to live ones and restart dead workers after a delay"""
+        now = time.monotonic()
+        joined = set()
+        for worker_id, process in list(self._processes.items()):
+            if worker_id in self._restart_at:
+                if now >= self._restart_at[worker_id]:
+                    del self._restart_at[worker_id]
+                    self._spawn(worker_id)
+                    joined.add(worker_id)
+            elif not process.is_alive():
+                logger.error('Bot worker %s left with exit code %s', worker_id, process.exitcode)
+                self._router.remove(worker_id)
+                self._restart_at[worker_id] = now + WORKER_RESTART_DELAY
+        # Chats of a left worker only move to the live ones, which have nothing to give away then
+        if joined:
+            self._rebalance(joined)
+
+    def start(self):
+        """Start all workers"""
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+    def forward(self, update: Update, context: CallbackContext) -> None:  # pylint: disable=unused-argument
+        """Send update to the worker owning its chat"""
+        self._check_workers()
+        if not self._router.workers:
+            logger.error('No live bot workers, update %s dropped', update.update_id)
+            return
+
+        if update.effective_chat:
+            chat_id = update.effective_chat.id
+        elif update.effective_user:
+            chat_id = update.effective_user.id
+        else:
+            chat_id = 0
+        self._queues[self._router.route(chat_id)].put(update.to_dict())
+
+    def stop(self):
+        """Let workers finish queued updates and stop them"""
+        for worker_id, process in self._processes.items():
+            if process.is_alive():
+                self._queues[worker_id].put(None)
+        for process in self._processes.values():
+            process.join()
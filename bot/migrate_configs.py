@@ -0,0 +1,80 @@
+"""
+Rewrite user configs in the compact form: packed colors, default values removed.
+
+Configs are rewritten in small batches with pauses, so the bot keeps working during the migration.
+A config changed by the bot while its batch is processed is left as is, the bot writes the compact form anyway.
+
+    python migrate_configs.py [--batch-size 500] [--pause 0.2] [--dry-run]
+"""
+import argparse
+import logging
+import time
+
+from pymongo import MongoClient, UpdateOne
+
+from config import DEFAULT_DOCUMENT, compact_update
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+logger = logging.getLogger(__name__)
+
+
+def migration_update(document: dict):
+    """Filter and update making the config compact, None if it is compact already"""
+    fields = {key: document[key] for key in DEFAULT_DOCUMENT if key in document}
+    update = compact_update(fields)
+    changes = {key: value for key, value in update.get('$set', {}).items() if document[key] != value}
+    if changes:
+        update['$set'] = changes
+    else:
+        update.pop('$set', None)
+    if not update:
+        return None
+
+    touched = {*update.get('$set', {}), *update.get('$unset', {})}
+    # Changed by the bot since it was read means already written in the compact form
+    config_filter = {'_id': document['_id'], **{key: document[key] for key in touched}}
+    return config_filter, update
+
+
+def migrate(configs_db, batch_size: int, pause: float, dry_run: bool):
+    """Go over the configs in _id order, rewriting a batch at a time"""
+    last_id = None
+    scanned = 0
+    migrated = 0
+    while True:
+        query = {} if last_id is None else {'_id': {'$gt': last_id}}
+        batch = list(configs_db.find(query).sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]['_id']
+        scanned += len(batch)
+
+        requests = [UpdateOne(*update) for update in map(migration_update, batch) if update]
+        if requests and not dry_run:
+            migrated += configs_db.bulk_write(requests, ordered=False).modified_count
+        elif requests:
+            migrated += len(requests)
+
+        logger.info('Scanned %s configs, migrated %s', scanned, migrated)
+        time.sleep(pause)
+
+    return scanned, migrated
+
+
+def main():
+    """Migration command"""
+    parser = argparse.ArgumentParser(description='Rewrite user configs in the compact form')
+    parser.add_argument('--mongo', default='mongodb://mongo', help='MongoDB connection string')
+    parser.add_argument('--batch-size', type=int, default=500, help='configs rewritten at once')
+    parser.add_argument('--pause', type=float, default=0.2, help='seconds to wait between batches')
+    parser.add_argument('--dry-run', action='store_true', help='only count configs to migrate')
+    args = parser.parse_args()
+
+    configs_db = MongoClient(args.mongo).instaimg.configs
+    scanned, migrated = migrate(configs_db, args.batch_size, args.pause, args.dry_run)
+    logger.info('Done, %s of %s configs %s', migrated, scanned, 'to migrate' if args.dry_run else 'migrated')
+
+
+if __name__ == '__main__':
+    main()
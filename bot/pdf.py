@@ -0,0 +1,176 @@
+"""
+PDF documents from text pages
+"""
+import zlib
+from pathlib import Path
+
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen.canvas import Canvas
+
+from text_to_image import EMOJI, ITALIC_SLANT, Run, TextToImages
+
+
+class RasterPdfWriter:
+    """
+    Write page images to PDF one by one.
+
+    Every page is written as soon as it is added, only object offsets are kept until the end.
+    """
+
+    def __init__(self, output):
+        self._output = output
+        self._position = 0
+        self._offsets = {}
+        self._page_ids = []
+        # 1 is the catalog and 2 is the pages tree, both are written in the end
+        self._next_id = 3
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data: bytes):
+        self._output.write(data)
+        self._position += len(data)
+
+    def _new_id(self) -> int:
+        object_id = self._next_id
+        self._next_id += 1
+        return object_id
+
+    def _write_object(self, object_id: int, dictionary: str, stream: bytes = None):
+        self._offsets[object_id] = self._position
+        self._write(f'{object_id} 0 obj\n{dictionary}'.encode())
+        if stream is not None:
+            self._write(b'\nstream\n' + stream + b'\nendstream')
+        self._write(b'\nendobj\n')
+
+    def add_page(self, image):
+        """Write page with the image, one image pixel is one point"""
+        image = image.convert('RGB')
+        width, height = image.size
+        image_id, content_id, page_id = self._new_id(), self._new_id(), self._new_id()
+
+        pixels = zlib.compress(image.tobytes())
+        self._write_object(image_id,
+                           f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} '
+                           f'/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /Length {len(pixels)} >>',
+                           pixels)
+
+        content = f'q {width} 0 0 {height} 0 0 cm /Im0 Do Q'.encode()
+        self._write_object(content_id, f'<< /Length {len(content)} >>', content)
+
+        self._write_object(page_id,
+                           f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] '
+                           f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>')
+        self._page_ids.append(page_id)
+
+    def close(self):
+        """Write pages tree, catalog and cross-reference table"""
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self._page_ids)
+        self._write_object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>')
+        self._write_object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref_position = self._position
+        xref = [f'xref\n0 {self._next_id}\n', '0000000000 65535 f \n']
+        xref.extend(f'{self._offsets[object_id]:010d} 00000 n \n' for object_id in range(1, self._next_id))
+        self._write(''.join(xref).encode())
+        self._write(f'trailer\n<< /Size {self._next_id} /Root 1 0 R >>\nstartxref\n{xref_position}\n%%EOF\n'.encode())
+
+
+def _register_font(font_path: Path) -> str:
+    """Register TrueType font once, it is embedded into documents as a subset of used glyphs"""
+    font_name = font_path.stem
+    if font_name not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(font_name, str(font_path)))
+    return font_name
+
+
+class VectorPdfWriter:
+    """Draw pages text with the fonts embedded into PDF, placing and styling it like TextToImages does"""
+
+    def __init__(self, output, renderer: TextToImages, font_files: dict):
+        self._renderer = renderer
+        self._font_files = font_files
+        self._canvas = Canvas(output, pagesize=(renderer.width, renderer.height), pageCompression=1)
+        # Same image data is written once and shared by the pages
+        self._background = ImageReader(renderer.background) if renderer.background else None
+
+    def _draw_segment(self, text_x, baseline_y, text: str, name: str, size: int, synthetic_bold, synthetic_italic):
+        canvas = self._canvas
+        # Text render mode stays in the graphics state until it is restored
+        canvas.saveState()
+        pdf_text = canvas.beginText()
+        pdf_text.setFont(_register_font(self._font_files[name]), size)
+        if synthetic_bold:
+            # Fill and stroke glyphs
+            pdf_text.setTextRenderMode(2)
+            canvas.setLineWidth(max(1, size // 30))
+        if synthetic_italic:
+            pdf_text.setTextTransform(1, 0, ITALIC_SLANT, 1, text_x, baseline_y)
+        else:
+            pdf_text.setTextOrigin(text_x, baseline_y)
+        pdf_text.textOut(text)
+        canvas.drawText(pdf_text)
+        canvas.restoreState()
+
+    def _draw_run(self, text_x, text_y, run: Run):
+        canvas = self._canvas
+        fonts = self._renderer.fonts
+        _, font, synthetic_bold, synthetic_italic = fonts.resolve(run.style)
+        # PDF vertical axis goes up from the baseline, image one goes down from the ascender
+        baseline_y = self._renderer.height - text_y - self._renderer.font.getmetrics()[0]
+
+        segment_x = text_x
+        for name, text in fonts.segments(run.text, run.style):
+            if name == EMOJI:
+                # Emoji stay bitmaps, as in photos
+                emoji = fonts.emoji.get(text, font.size)
+                width, height = emoji.size
+                canvas.drawImage(ImageReader(emoji),
+                                 segment_x,
+                                 baseline_y + fonts.emoji.ascent(font.size) - height,
+                                 width,
+                                 height,
+                                 mask='auto')
+                segment_x += width
+                continue
+            segment_font = fonts.font(name)
+            # Fallback fonts have no bold and italic variants
+            self._draw_segment(segment_x,
+                               baseline_y,
+                               text,
+                               name,
+                               font.size,
+                               synthetic_bold or (run.style.bold and segment_font is not font),
+                               synthetic_italic or (run.style.italic and segment_font is not font))
+            segment_x += fonts.width(text, run.style)
+
+        line_width = max(1, font.size // 15)
+        canvas.setLineWidth(line_width)
+        if run.style.underline:
+            canvas.line(text_x, baseline_y - line_width, segment_x, baseline_y - line_width)
+        if run.style.strikethrough:
+            strikethrough_y = baseline_y + font.getmetrics()[0] // 3
+            canvas.line(text_x, strikethrough_y, segment_x, strikethrough_y)
+
+    def add_page(self, lines):
+        """Draw page with split text lines"""
+        canvas = self._canvas
+        renderer = self._renderer
+
+        if self._background:
+            canvas.drawImage(self._background, 0, 0, renderer.width, renderer.height)
+        else:
+            canvas.setFillColorRGB(*(channel / 255 for channel in renderer.background_color))
+            canvas.rect(0, 0, renderer.width, renderer.height, stroke=0, fill=1)
+
+        canvas.setFillColorRGB(*(channel / 255 for channel in renderer.font_color))
+        canvas.setStrokeColorRGB(*(channel / 255 for channel in renderer.font_color))
+        for text_x, text_y, run in renderer.layout_part(lines):
+            self._draw_run(text_x, text_y, run)
+
+        canvas.showPage()
+
+    def close(self):
+        """Write the document"""
+        self._canvas.save()
@@ -0,0 +1,203 @@
+"""
+Conversation states persistence
+"""
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from threading import Event, Lock, Thread
+
+from pymongo import DeleteOne, UpdateOne
+from telegram.ext import BasePersistence
+
+# Seconds between writes of changed conversation states
+FLUSH_INTERVAL = 5
+# Conversations of this many chats per handler are kept in memory, the least recently used are read again
+MAX_LOADED_CONVERSATIONS = 10000
+# Loads of the states slower than this are logged, seconds
+SLOW_LOAD = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+class LazyConversations(dict):
+    """
+    Conversation states of a handler, states of a chat are loaded from MongoDB on its first access.
+
+    The load is one query by the indexed key, made on the dispatcher thread while the handler
+    checks the update, a database round trip per chat which is new or was evicted.
+    """
+
+    def __init__(self, persistence, name: str):
+        super().__init__()
+        self.persistence = persistence
+        self.name = name
+        # Loaded keys from the least recently used
+        self.loaded = OrderedDict()
+
+    def _load(self, key):
+        if key in self.loaded:
+            self.loaded.move_to_end(key)
+        else:
+            self.persistence.load_conversations(key)
+
+    def get(self, key, default=None):
+        self._load(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self._load(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        self._load(key)
+        return super().__getitem__(key)
+
+
+class MongoPersistence(BasePersistence):
+    """
+    Keep ConversationHandler states in memory and write changed ones to MongoDB in batches.
+
+    States are written every FLUSH_INTERVAL seconds and on shutdown, so a state transition
+    does not wait for the database.
+    """
+
+    def __init__(self, collection, flush_interval: float = FLUSH_INTERVAL):
+        super().__init__(store_user_data=False, store_chat_data=False, store_bot_data=False)
+        self.collection = collection
+        self.collection.create_index('key')
+        self.flush_interval = flush_interval
+        self._conversations = {}
+        self._dirty = {}
+        # States being written, they are not in MongoDB yet
+        self._writing = {}
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._stopped = Event()
+        self._flusher = Thread(target=self._flush_loop, name='conversations-flusher', daemon=True)
+        self._flusher.start()
+
+    @staticmethod
+    def _document_id(name: str, key) -> str:
+        return f'{name}:' + ':'.join(str(part) for part in key)
+
+    def _unwritten(self) -> dict:
+        """States not in MongoDB yet by handler name and key"""
+        with self._lock:
+            return {**self._writing, **self._dirty}
+
+    def load_conversations(self, key):
+        """Load states of all the handlers for the conversation key"""
+        # States missing here are in MongoDB already, they leave the unwritten ones only when written
+        pending = {name: state for (name, unwritten_key), state in self._unwritten().items()
+                   if unwritten_key == key}
+        start = time.monotonic()
+        stored = {document['name']: document['state'] for document in self.collection.find({'key': list(key)})}
+        elapsed = time.monotonic() - start
+        if elapsed > SLOW_LOAD:
+            logger.warning('Loading conversation states of %s took %.3f s', key, elapsed)
+        stored.update(pending)
+
+        for name, conversations in self._conversations.items():
+            if key in conversations.loaded:
+                continue
+            conversations.loaded[key] = None
+            if stored.get(name) is not None:
+                dict.__setitem__(conversations, key, stored[name])
+            self._evict(name, conversations, key)
+
+    def _evict(self, name: str, conversations: LazyConversations, loading_key):
+        """Forget the least recently used conversations over the limit, unwritten states are kept"""
+        excess = len(conversations.loaded) - MAX_LOADED_CONVERSATIONS
+        if excess <= 0:
+            return
+        unwritten = {key for unwritten_name, key in self._unwritten() if unwritten_name == name}
+        evicted = []
+        for key in conversations.loaded:
+            if len(evicted) == excess:
+                break
+            if key != loading_key and key not in unwritten:
+                evicted.append(key)
+        for key in evicted:
+            del conversations.loaded[key]
+            dict.pop(conversations, key, None)
+
+    def release_conversations(self, owned) -> None:
+        """
+        Write changed states and forget the conversations whose keys are not owned anymore.
+
+        Their chats are handled by another process now, which may change the states, so they
+        are read from MongoDB again if the chats come back.
+        """
+        self._write_dirty()
+        for conversations in self._conversations.values():
+            for key in set(conversations.loaded) | set(conversations):
+                if not owned(key):
+                    conversations.loaded.pop(key, None)
+                    dict.pop(conversations, key, None)
+
+    def _write_dirty(self):
+        """Write changed states to MongoDB in one batch, waiting for a write in progress first"""
+        with self._write_lock:
+            self._write_batch()
+
+    def _write_batch(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._writing = dirty
+        if not dirty:
+            return
+
+        requests = []
+        for (name, key), state in dirty.items():
+            document_id = self._document_id(name, key)
+            if state is None:
+                requests.append(DeleteOne({'_id': document_id}))
+            else:
+                requests.append(UpdateOne({'_id': document_id},
+                                          {'$set': {'name': name, 'key': list(key), 'state': state}},
+                                          upsert=True))
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to write %s conversation states', len(requests))
+            with self._lock:
+                # Newer states win over the ones we failed to write
+                self._dirty = {**dirty, **self._dirty}
+        finally:
+            with self._lock:
+                self._writing = {}
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            self._write_dirty()
+
+    def get_conversations(self, name: str):
+        conversations = LazyConversations(self, name)
+        self._conversations[name] = conversations
+        return conversations
+
+    def update_conversation(self, name: str, key, new_state) -> None:
+        with self._lock:
+            self._dirty[(name, key)] = new_state
+
+    def flush(self) -> None:
+        self._stopped.set()
+        self._write_dirty()
+
+    def get_user_data(self):
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def update_user_data(self, user_id, data) -> None:
+        pass
+
+    def update_chat_data(self, chat_id, data) -> None:
+        pass
+
+    def update_bot_data(self, data) -> None:
+        pass
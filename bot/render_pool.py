@@ -0,0 +1,167 @@
+"""
+Render worker processes
+"""
+import io
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context, resource_tracker, shared_memory
+
+from config import UserConfig
+from rendering import create_renderer, encode_image, render_changed_pages, render_pages, render_first_page, \
+    render_text
+
+
+def _to_shared_memory(page: io.BytesIO):
+    """Copy encoded page to a new shared memory block, the receiving side unlinks it"""
+    buffer = page.getbuffer()
+    # Explicit name, because the default one comes from stdlib secrets module which is shadowed by our secrets.py
+    block = shared_memory.SharedMemory(name=f'instaimg_{uuid.uuid4().hex}', create=True, size=max(len(buffer), 1))
+    try:
+        block.buf[:len(buffer)] = buffer
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    # Don't let this process' resource tracker remove the block, it is owned by the receiver now
+    resource_tracker.unregister(block._name, 'shared_memory')  # pylint: disable=protected-access
+    block.close()
+    return block.name, len(buffer), page.name
+
+
+def _unlink(name: str):
+    """Free shared memory block which nobody is going to read"""
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+def _pages_to_shared_memory(pages):
+    """Copy encoded pages to shared memory blocks as they are rendered, freeing them all if rendering fails"""
+    blocks = []
+    try:
+        for page in pages:
+            blocks.append(_to_shared_memory(page))
+    except BaseException:
+        # The receiver never gets the names of the blocks written so far
+        for name, _, _ in blocks:
+            _unlink(name)
+        raise
+    return blocks
+
+
+def _from_shared_memory(name: str, size: int, page_name: str) -> io.BytesIO:
+    """Read encoded page from shared memory block and free the block"""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        page = io.BytesIO(block.buf[:size])
+        page.name = page_name
+        return page
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _pages_from_shared_memory(blocks) -> list:
+    """Read encoded pages from shared memory blocks, every block is freed even if reading one fails"""
+    try:
+        return [_from_shared_memory(*block) for block in blocks]
+    except BaseException:
+        for name, _, _ in blocks:
+            _unlink(name)
+        raise
+
+
+def _free_abandoned(result_blocks, future):
+    """Free the blocks of a job result which arrived after the receiver stopped waiting for it"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    for name, _, _ in result_blocks(future.result()):
+        _unlink(name)
+
+
+def _job_result(future, result_blocks=list):
+    """Result of the job, its blocks are freed later if waiting for it is interrupted"""
+    try:
+        return future.result()
+    except BaseException:
+        future.add_done_callback(partial(_free_abandoned, result_blocks))
+        raise
+
+
+def _render_pages_job(user_config: UserConfig, text):
+    """Render all the text pages in a worker process"""
+    return _pages_to_shared_memory(render_pages(user_config, text))
+
+
+def _render_parts_job(user_config: UserConfig, parts):
+    """Render already split text parts in a worker process"""
+    tti = create_renderer(user_config)
+    return _pages_to_shared_memory(encode_image(tti.render_part(part)) for part in parts)
+
+
+def _render_text_job(user_config: UserConfig, text, rendered_hashes, render: bool):
+    """Split text and render the changed pages in a worker process"""
+    parts, hashes, changed, images = render_changed_pages(user_config, text, rendered_hashes, render)
+    return parts, hashes, changed, _pages_to_shared_memory(images)
+
+
+def _render_first_page_job(user_config: UserConfig, text, scale: int):
+    """Render the first text page in a worker process"""
+    return _to_shared_memory(render_first_page(user_config, text, scale))
+
+
+class RenderPool:
+    """Render texts in worker processes, or in the current one if there are no workers"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(workers, mp_context=get_context('spawn')) if workers else None
+
+    def render_pages(self, user_config: UserConfig, text):
+        """Render all the text pages, plain text or styled runs, to image buffers in pages order"""
+        if self._executor is None:
+            return list(render_pages(user_config, text))
+
+        blocks = _job_result(self._executor.submit(_render_pages_job, user_config, text))
+        return _pages_from_shared_memory(blocks)
+
+    def render_text(self, user_config: UserConfig, text, rendered_hashes=(), render: bool = True):
+        """
+        Split text, plain or styled runs, into pages and render the ones changed since the rendered page hashes.
+
+        Return the split parts, their hashes and image buffers of the changed pages by their indexes.
+        """
+        if self._executor is None:
+            return render_text(user_config, text, rendered_hashes, render)
+
+        parts, hashes, changed, blocks = _job_result(
+            self._executor.submit(_render_text_job, user_config, text, list(rendered_hashes), render),
+            lambda result: result[3])
+        return parts, hashes, dict(zip(changed, _pages_from_shared_memory(blocks)))
+
+    def render_parts(self, user_config: UserConfig, parts):
+        """Render already split text parts to image buffers, in parts order"""
+        if self._executor is None:
+            tti = create_renderer(user_config)
+            return [encode_image(tti.render_part(part)) for part in parts]
+
+        blocks = _job_result(self._executor.submit(_render_parts_job, user_config, parts))
+        return _pages_from_shared_memory(blocks)
+
+    def render_first_page(self, user_config: UserConfig, text, scale: int = 1) -> io.BytesIO:
+        """Render only the first text page"""
+        if self._executor is None:
+            return render_first_page(user_config, text, scale)
+
+        block = _job_result(self._executor.submit(_render_first_page_job, user_config, text, scale),
+                            lambda block: [block])
+        return _pages_from_shared_memory([block])[0]
+
+    def shutdown(self):
+        """Stop worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown()
@@ -0,0 +1,278 @@
+"""
+Render user texts to images
+"""
+import hashlib
+import io
+import logging
+import zlib
+from functools import lru_cache
+from pathlib import Path
+
+from fontTools.ttLib import TTFont
+from PIL import Image, ImageFont
+
+from backgrounds import make_background
+from cache import LRUCache
+from custom_fonts import custom_font_file
+from emoji import EmojiAtlas
+from text_to_image import CHAR_CACHE_SIZE, Coverage, StyledFonts, TextToImages
+
+DEFAULT_FONT_FAMILY = 'roboto'
+DEFAULT_FONT_SIZE = 40
+DEFAULT_FONT_COLOR = (0, 0, 0)
+DEFAULT_BACKGROUND_COLOR = (255, 255, 255)
+DEFAULT_ORIENTATION = 'square'
+DEFAULT_ALIGNMENT = 'left'
+DEFAULT_OUTPUT = 'photos'
+
+DEFAULT_IMG_WIDTH = 720
+
+# Target size of an encoded page, bigger pages are encoded with losses
+PAGE_BYTE_BUDGET = 256 * 1024
+# Size estimate compresses bands of this many rows, one of every ESTIMATE_BAND_STEP bands
+ESTIMATE_BAND_HEIGHT = 8
+ESTIMATE_BAND_STEP = 8
+
+MONOSPACE_FONTS = {'mono': 'DejaVuSansMono.ttf',
+                   'mono-bold': 'DejaVuSansMono-Bold.ttf'}
+
+# Missing bold and italic variants are synthesized
+FONTS = {'roboto': {'regular': 'Roboto-Regular.ttf',
+                    'bold': 'Roboto-Bold.ttf',
+                    'italic': 'Roboto-Italic.ttf',
+                    'bold-italic': 'Roboto-BoldItalic.ttf',
+                    **MONOSPACE_FONTS},
+         'raleway': {'regular': 'Raleway-Regular.ttf',
+                     **MONOSPACE_FONTS},
+         'playfair': {'regular': 'PlayfairDisplay-Regular.ttf',
+                      **MONOSPACE_FONTS}}
+
+SYSTEM_FONTS_DIR = Path('/usr/share/fonts/truetype')
+SANS_FALLBACK_FONTS = (SYSTEM_FONTS_DIR / 'dejavu' / 'DejaVuSans.ttf',
+                       SYSTEM_FONTS_DIR / 'wqy' / 'wqy-zenhei.ttc',
+                       SYSTEM_FONTS_DIR / 'ancient-scripts' / 'Symbola_hint.ttf')
+SERIF_FALLBACK_FONTS = (SYSTEM_FONTS_DIR / 'dejavu' / 'DejaVuSerif.ttf',
+                        *SANS_FALLBACK_FONTS)
+
+# Fonts for the characters missing from the family, in the order of preference
+FONT_FALLBACKS = {'roboto': SANS_FALLBACK_FONTS,
+                  'raleway': SANS_FALLBACK_FONTS,
+                  'playfair': SERIF_FALLBACK_FONTS}
+
+EMOJI_FONT = SYSTEM_FONTS_DIR / 'noto' / 'NotoColorEmoji.ttf'
+# Emoji images kept per process, at most a few dozen kilobytes each
+EMOJI_ATLAS_SIZE = 1024
+
+# Loaded font variants kept per process, by the estimate of the memory they take
+FONTS_CACHE_BYTES = 64 * 1024 * 1024
+# FreeType face with its loaded glyphs on top of the font file data, rough estimate per variant
+FONT_FACE_BYTES = 128 * 1024
+# Full caches of character advances and fonts of a variant, about 230 bytes per character
+CHAR_CACHE_BYTES = CHAR_CACHE_SIZE * 230
+
+# Background templates kept per process, by their size in bytes
+BACKGROUNDS_CACHE_BYTES = 64 * 1024 * 1024
+
+ORIENTATION = {'square': (DEFAULT_IMG_WIDTH, DEFAULT_IMG_WIDTH),
+               'vertical': (DEFAULT_IMG_WIDTH, DEFAULT_IMG_WIDTH // 4 * 5),
+               'horizontal': (DEFAULT_IMG_WIDTH, DEFAULT_IMG_WIDTH // 16 * 9),
+               'stories': (DEFAULT_IMG_WIDTH, DEFAULT_IMG_WIDTH // 9 * 16)}
+
+logger = logging.getLogger(__name__)
+
+emoji_atlas = EmojiAtlas(str(EMOJI_FONT), EMOJI_ATLAS_SIZE) if EMOJI_FONT.exists() else None
+# (font family, font size) -> StyledFonts
+loaded_fonts = LRUCache(FONTS_CACHE_BYTES)
+# (background key, page size) -> page template
+background_templates = LRUCache(BACKGROUNDS_CACHE_BYTES)
+
+
+def font_files(font_family: str) -> dict:
+    """Font files of the family variants"""
+    custom_file = custom_font_file(font_family)
+    if custom_file:
+        return {'regular': custom_file,
+                **{variant: Path('.') / 'fonts' / file_name for variant, file_name in MONOSPACE_FONTS.items()}}
+    return {variant: Path('.') / 'fonts' / file_name
+            for variant, file_name in FONTS.get(font_family, FONTS[DEFAULT_FONT_FAMILY]).items()}
+
+
+def fallback_files(font_family: str) -> dict:
+    """Installed fallback font files of the family, in the order of preference"""
+    return {path.stem: path
+            for path in FONT_FALLBACKS.get(font_family, FONT_FALLBACKS[DEFAULT_FONT_FAMILY])
+            if path.exists()}
+
+
+@lru_cache(maxsize=1024)
+def get_coverage(font_path: Path) -> Coverage:
+    """Characters of the font by its cmap, read once per font file"""
+    # The first font of a collection is the one ImageFont.truetype loads by default
+    font = TTFont(str(font_path), fontNumber=0, lazy=True)
+    try:
+        return Coverage(font.getBestCmap() or ())
+    finally:
+        font.close()
+
+
+@lru_cache(maxsize=64)
+def get_fallback_font(font_path: Path, font_size: int):
+    """Fallback fonts are few and shared by all the families"""
+    return ImageFont.truetype(str(font_path), font_size)
+
+
+def get_fonts(font_family: str, font_size: int) -> StyledFonts:
+    """
+    Load font variants once per family and size.
+
+    Variants are loaded from memory, so that their size is known and no file stays open
+    for every uploaded font, the least recently used ones are dropped when they take too much.
+    Fallback fonts and coverages are shared and bounded by their own caches.
+    """
+    key = (font_family, font_size)
+    fonts = loaded_fonts.get(key)
+    if fonts is not None:
+        return fonts
+
+    variants = font_files(font_family)
+    fallbacks = fallback_files(font_family)
+    variants_data = {variant: path.read_bytes() for variant, path in variants.items()}
+    fonts = StyledFonts({variant: ImageFont.truetype(io.BytesIO(data), font_size)
+                         for variant, data in variants_data.items()},
+                        {name: get_fallback_font(path, font_size) for name, path in fallbacks.items()},
+                        {name: get_coverage(path) for name, path in {**variants, **fallbacks}.items()},
+                        emoji_atlas)
+    loaded_fonts.put(key, fonts, sum(len(data) + FONT_FACE_BYTES + CHAR_CACHE_BYTES for data in variants_data.values()))
+    return fonts
+
+
+def get_background(key, size):
+    """Page background template, made once per background and page size"""
+    if key is None:
+        return None
+
+    template = background_templates.get((key, size))
+    if template is None:
+        template = make_background(key, size)
+        if template is None:
+            return None
+        width, height = size
+        background_templates.put((key, size), template, width * height * len(template.getbands()))
+    return template
+
+
+def create_renderer(user_config, scale: int = 1) -> TextToImages:
+    """Make renderer for UserConfig, `scale` times smaller than a full-size image"""
+    img_width, img_height = user_config.page_size
+    size = (img_width // scale, img_height // scale)
+    if scale == 1:
+        fonts = user_config.fonts
+    else:
+        fonts = get_fonts(user_config.font_family, user_config.font_size // scale)
+    return TextToImages(*size,
+                        fonts,
+                        user_config.background_color,
+                        user_config.font_color,
+                        user_config.alignment,
+                        get_background(user_config.background, size))
+
+
+def estimate_png_size(image) -> int:
+    """Upper estimate of PNG size by fast compression of a sample of the image rows"""
+    width, height = image.size
+    bands = [(top, min(top + ESTIMATE_BAND_HEIGHT, height))
+             for top in range(0, height, ESTIMATE_BAND_HEIGHT * ESTIMATE_BAND_STEP)]
+    if not bands:
+        return 0
+    sample = b''.join(image.crop((0, top, width, bottom)).tobytes() for top, bottom in bands)
+    sampled_rows = sum(bottom - top for top, bottom in bands)
+    return len(zlib.compress(sample, 1)) * height // sampled_rows
+
+
+def encode_image(image, byte_budget: int = PAGE_BYTE_BUDGET, lossy_format: str = 'JPEG') -> io.BytesIO:
+    """
+    Encode image choosing the format by the size estimate.
+
+    Text on a plain background has few colors, so a palette PNG is lossless and small. Images which
+    don't fit the budget even so are encoded with losses, with lower quality for bigger estimates.
+    The choice is recorded in the buffer name, e.g. `palette-l6.png` or `jpeg-q80.jpg`.
+    """
+    colors = image.getcolors(256)
+    if colors:
+        image = image.convert('P', palette=Image.ADAPTIVE, colors=len(colors))
+    estimate = estimate_png_size(image)
+
+    img_byte_arr = io.BytesIO()
+    if estimate <= byte_budget:
+        # Maximum compression is slow and pays off only when close to the budget
+        compress_level = 6 if estimate <= byte_budget // 2 else 9
+        image.save(img_byte_arr, format='PNG', compress_level=compress_level)
+        img_byte_arr.name = f'{"palette" if colors else "rgb"}-l{compress_level}.png'
+    else:
+        if estimate <= 2 * byte_budget:
+            quality = 90
+        elif estimate <= 4 * byte_budget:
+            quality = 80
+        else:
+            quality = 70
+        image.convert('RGB').save(img_byte_arr, format=lossy_format, quality=quality)
+        img_byte_arr.name = f'{lossy_format.lower()}-q{quality}.{"jpg" if lossy_format == "JPEG" else "webp"}'
+
+    logger.debug('Page encoded as %s, estimate %s, size %s', img_byte_arr.name, estimate, img_byte_arr.tell())
+    img_byte_arr.seek(0)
+    return img_byte_arr
+
+
+def split_pages(tti: TextToImages, text):
+    """Split plain text or styled text runs into image parts"""
+    if isinstance(text, str):
+        return tti.split_text(text, True)
+    return tti.split_runs(text)
+
+
+def page_hash(part) -> bytes:
+    """Hash of the split text page, equal for pages with the same lines in any process"""
+    return hashlib.blake2b(repr(part).encode(), digest_size=8).digest()
+
+
+def changed_pages(hashes, rendered_hashes) -> list:
+    """Indexes of the pages which differ from the rendered ones or were not rendered"""
+    return [i for i, page in enumerate(hashes) if i >= len(rendered_hashes) or page != rendered_hashes[i]]
+
+
+def render_text(user_config, text, rendered_hashes=(), render: bool = True):
+    """
+    Split text into pages and render the ones changed since the rendered page hashes.
+
+    Return the split parts, their hashes and images of the changed pages by their indexes,
+    no images if `render` is False.
+    """
+    parts, hashes, changed, images = render_changed_pages(user_config, text, rendered_hashes, render)
+    return parts, hashes, dict(zip(changed, images))
+
+
+def render_changed_pages(user_config, text, rendered_hashes=(), render: bool = True):
+    """
+    Split text into pages and find the ones changed since the rendered page hashes.
+
+    Return the split parts, their hashes, indexes of the changed pages and a generator
+    rendering them in that order.
+    """
+    tti = create_renderer(user_config)
+    parts = split_pages(tti, text)
+    hashes = [page_hash(part) for part in parts]
+    changed = changed_pages(hashes, rendered_hashes) if render else []
+    return parts, hashes, changed, (encode_image(tti.render_part(parts[i])) for i in changed)
+
+
+def render_pages(user_config, text):
+    """Render all the text pages to image buffers"""
+    tti = create_renderer(user_config)
+    for part in split_pages(tti, text):
+        yield encode_image(tti.render_part(part))
+
+
+def render_first_page(user_config, text, scale: int = 1) -> io.BytesIO:
+    """Render only the first text page"""
+    tti = create_renderer(user_config, scale)
+    return encode_image(tti.render_part(split_pages(tti, text)[0]))
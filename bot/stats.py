@@ -0,0 +1,173 @@
+"""
+Usage statistics kept as pre-aggregated counters, so they are read without scanning the configs.
+
+Documents of the stats collection:
+
+    {'_id': 'total', 'users': ..., 'renders': ..., 'pages': ...}
+    {'_id': 'day:2021-02-01', 'active': ..., 'renders': ..., 'pages': ...}
+    {'_id': 'week:2021-W05', 'active': ...}
+    {'_id': 'month:2021-02', 'active': ...}
+
+A user is counted as active once per period, when their previous activity was before its start.
+
+Errors are grouped by type and normalized message in the error_groups collection, with daily counts
+in error_groups_daily:
+
+    {'_id': {'type': ..., 'key': ...}, 'count': ..., 'first_seen': ..., 'last_seen': ..., 'msg': ...}
+    {'_id': {'type': ..., 'key': ..., 'day': '2021-02-01'}, 'count': ...}
+
+Counters of users created before the statistics are restored, and errors are regrouped, with
+
+    python stats.py [--mongo mongodb://mongo] [--errors]
+"""
+import argparse
+import logging
+import re
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient, UpdateOne
+
+from color_recognition import normalize_color
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+logger = logging.getLogger(__name__)
+
+TOTAL_ID = 'total'
+# Error type of the colors text_to_rgb didn't recognize, ET_UNKNOWN_COLOR in bot.py
+UNKNOWN_COLOR_TYPE = 'unknown color'
+# Message of their ValueError, with the color text as the user typed it
+UNKNOWN_COLOR_MSG = re.compile(r"'(.*)' color is unknown", re.DOTALL)
+# Stored errors are given keys in batches of this size
+KEYS_BATCH_SIZE = 1000
+
+
+def period_starts(now: datetime) -> dict:
+    """Start of the day, ISO week and month of the time by their stats document ids"""
+    # The admin site reads the counters by these ids, keep period_ids in web/main.py in sync
+    day = datetime(now.year, now.month, now.day)
+    iso_year, iso_week, _ = now.isocalendar()
+    return {f'day:{day:%Y-%m-%d}': day,
+            f'week:{iso_year}-W{iso_week:02}': day - timedelta(days=day.weekday()),
+            f'month:{day:%Y-%m}': day.replace(day=1)}
+
+
+def record_new_user(stats_db):
+    """Count a created user config"""
+    stats_db.update_one({'_id': TOTAL_ID}, {'$inc': {'users': 1}}, upsert=True)
+
+
+def record_activity(stats_db, previous_activity, now: datetime):
+    """Count the user as active in the periods they had no activity in before"""
+    requests = [UpdateOne({'_id': period_id}, {'$inc': {'active': 1}}, upsert=True)
+                for period_id, start in period_starts(now).items()
+                if previous_activity is None or previous_activity < start]
+    # Most messages come from users who were active today already
+    if requests:
+        stats_db.bulk_write(requests, ordered=False)
+
+
+def record_render(stats_db, pages: int, now: datetime):
+    """Count a rendered text of the number of pages"""
+    day_id = next(iter(period_starts(now)))
+    increments = {'$inc': {'renders': 1, 'pages': pages}}
+    stats_db.bulk_write([UpdateOne({'_id': TOTAL_ID}, increments, upsert=True),
+                         UpdateOne({'_id': day_id}, increments, upsert=True)], ordered=False)
+
+
+def error_key(msg: str) -> str:
+    """Error message normalized for grouping"""
+    return ' '.join(msg.lower().split())
+
+
+def record_error(db, error_type: str, key: str, msg: str, now: datetime):
+    """Count the error in its group, in total and for the day"""
+    group_id = {'type': error_type, 'key': key}
+    db.error_groups.update_one({'_id': group_id},
+                               {'$inc': {'count': 1},
+                                '$min': {'first_seen': now},
+                                '$max': {'last_seen': now},
+                                '$set': {'msg': msg}},
+                               upsert=True)
+    db.error_groups_daily.update_one({'_id': {**group_id, 'day': f'{now:%Y-%m-%d}'}},
+                                     {'$inc': {'count': 1}},
+                                     upsert=True)
+
+
+def stored_error_key(error_type: str, msg: str) -> str:
+    """Key the bot would give to a stored error which has none"""
+    match = UNKNOWN_COLOR_MSG.fullmatch(msg) if error_type == UNKNOWN_COLOR_TYPE else None
+    # Unknown colors are keyed by the color text, see the color input handlers
+    return normalize_color(match.group(1)) if match else error_key(msg)
+
+
+def add_missing_error_keys(errors_db):
+    """Set keys of the errors stored before the grouping"""
+    requests = []
+    for error in errors_db.find({'key': {'$exists': False}}, projection={'type': True, 'msg': True}):
+        requests.append(UpdateOne({'_id': error['_id']},
+                                  {'$set': {'key': stored_error_key(error['type'], error['msg'])}}))
+        if len(requests) == KEYS_BATCH_SIZE:
+            errors_db.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        errors_db.bulk_write(requests, ordered=False)
+
+
+def rebuild_error_groups(db):
+    """
+    Group all the stored errors again, replacing the error groups.
+
+    The groups are built in new collections with the indexes of the current ones and then renamed
+    over them, so counts the bot keeps adding are never mixed with half-written groups. Errors stored
+    while rebuilding may be left out, stop the bot for exact counts.
+    """
+    add_missing_error_keys(db.errors)
+    day = {'$dateToString': {'format': '%Y-%m-%d', 'date': '$timestamp'}}
+    # The latest message of a group is taken in the order of the errors
+    by_time = {'$sort': {'timestamp': 1}}
+    pipelines = {'error_groups': [by_time,
+                                  {'$group': {'_id': {'type': '$type', 'key': '$key'},
+                                              'count': {'$sum': 1},
+                                              'first_seen': {'$min': '$timestamp'},
+                                              'last_seen': {'$max': '$timestamp'},
+                                              'msg': {'$last': '$msg'}}}],
+                 'error_groups_daily': [{'$group': {'_id': {'type': '$type', 'key': '$key', 'day': day},
+                                                    'count': {'$sum': 1}}}]}
+    for name, pipeline in pipelines.items():
+        rebuilt = db[f'{name}_rebuilt']
+        rebuilt.drop()
+        # Output collection keeps its indexes
+        for index in db[name].list_indexes():
+            if index['name'] != '_id_':
+                rebuilt.create_index(list(index['key'].items()), name=index['name'])
+        db.errors.aggregate([*pipeline, {'$out': rebuilt.name}], allowDiskUse=True)
+        rebuilt.rename(name, dropTarget=True)
+    logger.info('%s error groups', db.error_groups.count_documents({}))
+
+
+def rebuild(configs_db, stats_db, now: datetime):
+    """Set users and active users counters of the current periods from the configs, renders are not restored"""
+    stats_db.update_one({'_id': TOTAL_ID}, {'$set': {'users': configs_db.count_documents({})}}, upsert=True)
+    for period_id, start in period_starts(now).items():
+        active = configs_db.count_documents({'last-activity': {'$gte': start}})
+        stats_db.update_one({'_id': period_id}, {'$set': {'active': active}}, upsert=True)
+        logger.info('%s: %s active users', period_id, active)
+
+
+def main():
+    """Rebuild command"""
+    parser = argparse.ArgumentParser(description='Restore users statistics from the configs and errors')
+    parser.add_argument('--mongo', default='mongodb://mongo', help='MongoDB connection string')
+    parser.add_argument('--errors', action='store_true', help='regroup the stored errors too')
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo).instaimg
+    rebuild(db.configs, db.stats, datetime.utcnow())
+    if args.errors:
+        rebuild_error_groups(db)
+    logger.info('Done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Chat-partitioned bot workers
+"""
+from functools import partial
+from multiprocessing import get_context
+
+from telegram import Bot, Update, User
+from telegram.ext import Filters, MessageHandler
+
+from fanout import FanOut
+
+TOKEN = '123456:test-token'
+
+
+def _reply(results, update: Update, context):  # pylint: disable=unused-argument
+    results.put(update.message.text)
+
+
+def _setup(results, dispatcher):
+    # Dispatcher asks Telegram for the bot name otherwise
+    dispatcher.bot._bot = User(1, 'Test', is_bot=True, username='test_bot')  # pylint: disable=protected-access
+    dispatcher.add_handler(MessageHandler(Filters.text, partial(_reply, results), run_async=True))
+
+
+def _no_persistence():
+    return None
+
+
+def _text_update(update_id: int, chat_id: int, text: str) -> Update:
+    return Update.de_json({'update_id': update_id,
+                           'message': {'message_id': update_id,
+                                       'date': 0,
+                                       'chat': {'id': chat_id, 'type': 'private'},
+                                       'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'},
+                                       'text': text}},
+                          Bot(TOKEN))
+
+
+def test_run_async_handlers_run_in_workers():
+    results = get_context('spawn').Queue()
+    fanout = FanOut(TOKEN, 2, partial(_setup, results), _no_persistence, dispatcher_workers=2)
+    fanout.start()
+    try:
+        for chat_id in range(1, 5):
+            fanout.forward(_text_update(chat_id, chat_id, f'text {chat_id}'), None)
+        handled = {results.get(timeout=30) for _ in range(4)}
+    finally:
+        fanout.stop()
+
+    assert handled == {f'text {chat_id}' for chat_id in range(1, 5)}
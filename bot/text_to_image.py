@@ -1,22 +1,242 @@
 """
 Convert text to images
 """
-from PIL import ImageFont, Image, ImageDraw
+import re
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+
+from PIL import Image, ImageDraw
 from typus import ru_typus
 from typus.chars import NNBSP, NBSP
 
+from emoji import split_emoji
+
 IMG_MODE = 'RGB'
 
+# Horizontal shift per pixel of height for fonts without italic variant
+ITALIC_SLANT = 0.2
+# Advances and fonts of this many characters are cached per variant, the caches start over when full
+CHAR_CACHE_SIZE = 2048
+
+Style = namedtuple('Style', 'bold italic mono underline strikethrough', defaults=(False, False, False, False, False))
+REGULAR = Style()
+
+# Font name of the text segments drawn as emoji images
+EMOJI = 'emoji'
+
+# Part of a text line drawn with the same style
+Run = namedtuple('Run', 'text style')
+
+# Telegram message entity types -> Style fields
+ENTITY_STYLES = {'bold': 'bold',
+                 'italic': 'italic',
+                 'code': 'mono',
+                 'pre': 'mono',
+                 'underline': 'underline',
+                 'strikethrough': 'strikethrough'}
+
+
+def typo_run(text: str) -> str:
+    """Apply typography rules keeping the spaces around the text, which typus strips"""
+    core = text.strip()
+    if not core:
+        return text
+    return text[:len(text) - len(text.lstrip())] + ru_typus(core) + text[len(text.rstrip()):]
+
+
+def entities_to_runs(text: str, entities, typo: bool = True):
+    """Split text into runs of the same style by Telegram message entities"""
+    # Entities offsets are in UTF-16 code units
+    encoded = text.encode('utf-16-le')
+    entities = [entity for entity in entities if entity.type in ENTITY_STYLES]
+    boundaries = {0, len(encoded) // 2}
+    for entity in entities:
+        boundaries.update((entity.offset, entity.offset + entity.length))
+    boundaries = sorted(boundaries)
+
+    runs = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        style = Style(**{ENTITY_STYLES[entity.type]: True
+                         for entity in entities
+                         if entity.offset <= start and end <= entity.offset + entity.length})
+        run_text = encoded[start * 2:end * 2].decode('utf-16-le')
+        if typo and not style.mono:
+            run_text = typo_run(run_text)
+        runs.append(Run(run_text, style))
+    return runs
+
+
+def runs_to_lines(runs):
+    """Split runs by line breaks, like str.splitlines does"""
+    line = []
+    ended = True
+    for run in runs:
+        for i, piece in enumerate(run.text.replace('\r\n', '\n').split('\n')):
+            if i:
+                yield tuple(line)
+                line = []
+                ended = True
+            if piece:
+                line.append(Run(piece, run.style))
+                ended = False
+    if line or not ended:
+        yield tuple(line)
+
+
+class Coverage:
+    """Code points supported by a font, kept as sorted intervals, so membership is a binary search"""
+
+    def __init__(self, code_points):
+        starts, ends = array('L'), array('L')
+        for code_point in sorted(code_points):
+            if ends and ends[-1] == code_point:
+                ends[-1] = code_point + 1
+            else:
+                starts.append(code_point)
+                ends.append(code_point + 1)
+        self._starts = starts
+        self._ends = ends
+
+    def __contains__(self, char: str) -> bool:
+        code_point = ord(char)
+        i = bisect_right(self._starts, code_point) - 1
+        return i >= 0 and code_point < self._ends[i]
+
+    def __len__(self):
+        return len(self._starts)
+
+
+class StyledFonts:
+    """
+    Variants of a font family, e.g. `regular`, `bold`, `italic`, `bold-italic`, `mono`, `mono-bold`.
+
+    Missing bold and italic variants are synthesized from the closest existing one.
+    Characters missing from a variant are taken from the first fallback font that has them,
+    fonts are chosen by their coverage, so text is split into same-font segments without trial rendering.
+    Emoji sequences are drawn from the emoji atlas, if there is one.
+    Glyph advances are cached per variant, so measuring mixed styles costs dictionary lookups,
+    for at most CHAR_CACHE_SIZE characters, texts mixing more scripts than that measure some twice.
+    """
+
+    def __init__(self, variants: dict, fallbacks: dict = None, coverages: dict = None, emoji=None):
+        self.variants = variants
+        self.regular = variants['regular']
+        self.fallbacks = fallbacks or {}
+        # Fonts without coverage are supposed to have all the characters
+        self._coverages = coverages or {}
+        self.emoji = emoji
+        self._resolved = {}
+        self._advances = {name: {} for name in variants}
+        self._char_fonts = {name: {} for name in variants}
+
+    @staticmethod
+    def _variant_name(mono: bool, bold: bool, italic: bool) -> str:
+        name = '-'.join(part for part, used in (('mono', mono), ('bold', bold), ('italic', italic)) if used)
+        return name or 'regular'
+
+    @staticmethod
+    def _candidates(style: Style):
+        """Variants to look for, from the exact one to the regular one"""
+        for mono in (True, False) if style.mono else (False,):
+            for bold in (True, False) if style.bold else (False,):
+                for italic in (True, False) if style.italic else (False,):
+                    yield mono, bold, italic
+
+    def resolve(self, style: Style):
+        """Variant name, font, and whether bold and italic have to be synthesized"""
+        key = (style.mono, style.bold, style.italic)
+        if key not in self._resolved:
+            for mono, bold, italic in self._candidates(style):
+                name = self._variant_name(mono, bold, italic)
+                if name in self.variants:
+                    self._resolved[key] = (name, self.variants[name], style.bold and not bold,
+                                           style.italic and not italic)
+                    break
+        return self._resolved[key]
+
+    def _covers(self, name: str, char: str) -> bool:
+        coverage = self._coverages.get(name)
+        return coverage is None or char in coverage
+
+    def _char_font(self, variant: str, char: str) -> str:
+        """Name of the font to draw the character of the variant with"""
+        char_fonts = self._char_fonts[variant]
+        name = char_fonts.get(char)
+        if name is None:
+            name = variant
+            if not char.isspace() and not self._covers(variant, char):
+                # Missing everywhere characters are left to the variant to draw its replacement glyph
+                name = next((fallback for fallback in self.fallbacks if self._covers(fallback, char)), variant)
+            if len(char_fonts) >= CHAR_CACHE_SIZE:
+                char_fonts.clear()
+            char_fonts[char] = name
+        return name
+
+    def font(self, name: str):
+        """Variant or fallback font by name"""
+        return self.variants.get(name) or self.fallbacks[name]
+
+    def _pieces(self, text: str):
+        """Split text into plain text and emoji sequences"""
+        if self.emoji is None:
+            return ((False, text),)
+        return split_emoji(text)
+
+    def _font_segments(self, text: str, variant: str):
+        start = 0
+        current = None
+        for i, char in enumerate(text):
+            name = self._char_font(variant, char)
+            if name != current:
+                if i:
+                    yield current, text[start:i]
+                start = i
+                current = name
+        if text:
+            yield current, text[start:]
+
+    def segments(self, text: str, style: Style = REGULAR):
+        """Split text into pieces drawn with the same font, yield font names (`EMOJI` for emoji) and pieces"""
+        variant = self.resolve(style)[0]
+        for is_emoji, piece in self._pieces(text):
+            if is_emoji:
+                yield EMOJI, piece
+            else:
+                yield from self._font_segments(piece, variant)
+
+    def _text_width(self, text: str, variant: str) -> float:
+        advances = self._advances[variant]
+        width = 0
+        for char in text:
+            advance = advances.get(char)
+            if advance is None:
+                if len(advances) >= CHAR_CACHE_SIZE:
+                    advances.clear()
+                advance = advances[char] = self.font(self._char_font(variant, char)).getlength(char)
+            width += advance
+        return width
+
+    def width(self, text: str, style: Style = REGULAR) -> float:
+        """Text advance width"""
+        variant = self.resolve(style)[0]
+        return sum(self.emoji.width(piece, self.regular.size) if is_emoji else self._text_width(piece, variant)
+                   for is_emoji, piece in self._pieces(text))
+
 
 class TextToImages:  # pylint: disable=too-many-instance-attributes
     """Make several images from text"""
 
-    def __init__(self, width: int, height: int, font: ImageFont, background_color, font_color, alignment: str):
-        self.font = font
+    def __init__(self, width: int, height: int, fonts: StyledFonts, background_color, font_color, alignment: str,
+                 background=None):
+        self.fonts = fonts
+        self.font = fonts.regular
         self.base_font_width, self.base_font_height = self.font.getsize('W')
         self.width = width
         self.height = height
         self.background_color = background_color
+        # Page template copied for every image instead of the flat background color
+        self.background = background
         self.image = None
         self._text_y = 0
         self._canvas = None
@@ -26,49 +246,116 @@ class TextToImages:  # pylint: disable=too-many-instance-attributes
         self.alignment = alignment
 
     def _reset_line(self):
-        """Start new image, place cursor in the beginning of the image"""
+        """Place cursor in the beginning of the image"""
         self._text_y = self.base_font_height
-        self.image = Image.new(IMG_MODE, (self.width, self.height), color=self.background_color)
-        self._canvas = ImageDraw.Draw(self.image)
-        self._canvas.font = self.font
         self._new_image = True
 
+    def _new_canvas(self):
+        """Start new image"""
+        if self.background:
+            self.image = self.background.copy()
+        else:
+            self.image = Image.new(IMG_MODE, (self.width, self.height), color=self.background_color)
+        self._canvas = ImageDraw.Draw(self.image)
+
     def _shift_line(self):
         """Shift cursor to new line"""
         self._new_image = False
         self._text_y += self.base_font_height + 2
 
-    def _draw_line(self, text):
-        """Print text line"""
+    def _runs_width(self, runs) -> float:
+        return sum(self.fonts.width(run.text, run.style) for run in runs)
+
+    @staticmethod
+    def _words(runs):
+        """Split line into words, every word is a list of runs and the space run after it or None"""
+        word = []
+        for run in runs:
+            for piece in re.split('( )', run.text):
+                if piece == ' ':
+                    yield word, Run(piece, run.style)
+                    word = []
+                elif piece:
+                    word.append(Run(piece, run.style))
+        if word:
+            yield word, None
+
+    def _line_fragments(self, runs):
+        """Horizontal positions of the text line runs"""
         if self.alignment == 'justify':
-            words = text.split()
-            text_size = self.font.getsize(''.join(words))[0]
+            words = [word for word, _ in self._words(runs) if word]
+            words_width = sum(self._runs_width(word) for word in words)
 
             if len(words) > 1:
-                white_space_width = (self._max_width - text_size) // (len(words) - 1)
+                white_space_width = (self._max_width - words_width) // (len(words) - 1)
             else:
                 white_space_width = 0
 
+            fragments = []
             text_start = self.base_font_width
             for word in words:
-                self._canvas.text((text_start, self._text_y), word, fill=self.font_color)
-                text_start += self.font.getsize(word)[0] + white_space_width
-
-        elif self.alignment == 'right':
-            text_width = self.font.getsize(text)[0]
-            self._canvas.text((self.width - self.base_font_width - text_width, self._text_y),
-                              text,
-                              fill=self.font_color)
+                for run in word:
+                    fragments.append((text_start, run))
+                    text_start += self.fonts.width(run.text, run.style)
+                text_start += white_space_width
+            return fragments
 
+        if self.alignment == 'right':
+            text_start = self.width - self.base_font_width - self._runs_width(runs)
         elif self.alignment == 'center':
-            text_width = self.font.getsize(text)[0]
-            self._canvas.text(((self.width - text_width) // 2, self._text_y), text, fill=self.font_color)
-
+            text_start = (self.width - self._runs_width(runs)) // 2
         else:
-            self._canvas.text((self.base_font_width, self._text_y), text, fill=self.font_color)
+            text_start = self.base_font_width
+
+        fragments = []
+        for run in runs:
+            fragments.append((text_start, run))
+            text_start += self.fonts.width(run.text, run.style)
+        return fragments
 
-        if text.strip() or not self._new_image:
-            self._shift_line()
+    def layout_part(self, lines):
+        """Positions of the text runs of an image"""
+        self._reset_line()
+        for line in lines:
+            for text_x, run in self._line_fragments(line):
+                yield text_x, self._text_y, run
+
+            if ''.join(run.text for run in line).strip() or not self._new_image:
+                self._shift_line()
+
+    def _break_line(self, runs):
+        """Break runs of a text line into lines fitting the image width"""
+        if self._runs_width(runs) <= self._max_width:
+            return [runs]
+
+        lines = []
+        line = []
+        line_width = 0
+        for word, space in self._words(runs):
+            word_width = self._runs_width(word)
+            if line and line_width + word_width > self._max_width:
+                lines.append(tuple(line))
+                line = []
+                line_width = 0
+            line.extend(word)
+            line_width += word_width
+            if space:
+                line.append(space)
+                line_width += self.fonts.width(space.text, space.style)
+        if line:
+            lines.append(tuple(line))
+        return lines
+
+    @staticmethod
+    def _merge_runs(runs):
+        """Join neighbour runs of the same style"""
+        merged = []
+        for run in runs:
+            if merged and merged[-1].style == run.style:
+                merged[-1] = Run(merged[-1].text + run.text, run.style)
+            else:
+                merged.append(run)
+        return tuple(merged)
 
     def split_text(self, text: str, typo: bool = True):
         """Split the text so that it fits into the images"""
@@ -77,47 +364,105 @@ class TextToImages:  # pylint: disable=too-many-instance-attributes
         else:
             text_to_process = text.splitlines()
 
-        parts = []
+        return list(self.iter_parts(text_to_process))
+
+    def split_runs(self, runs):
+        """Split styled text runs so that they fit into the images"""
+        return list(self.iter_parts(runs_to_lines(runs)))
+
+    def iter_parts(self, text_lines):
+        """
+        Split text lines so that they fit into the images, yield lines of every filled image.
+
+        Text lines are strings or tuples of runs, image lines are tuples of runs.
+        """
         lines = []
 
         text_y = self.base_font_height
 
-        for i_line in text_to_process:
-            if self.font.getsize(i_line)[0] <= self._max_width:
-                lines.append(i_line.replace(NNBSP, NBSP))
+        for i_line in text_lines:
+            if isinstance(i_line, str):
+                i_line = (Run(i_line, REGULAR),)
+            i_line = tuple(Run(run.text.replace(NNBSP, NBSP), run.style) for run in i_line)
+
+            for line in self._break_line(i_line):
+                lines.append(self._merge_runs(line))
                 text_y += self.base_font_height + 2
                 if text_y > self.height - self.base_font_height * 2:
                     text_y = self.base_font_height
-                    parts.append(lines)
+                    yield lines
                     lines = []
-            else:
-                words = i_line.replace(NNBSP, NBSP).split(' ')
-                i = 0
-                while i < len(words):
-                    line = ''
-                    while i < len(words) and self.font.getsize(line + words[i])[0] <= self._max_width:
-                        line = line + words[i] + " "
-                        i += 1
-                    if not line:
-                        line = words[i]
-                        i += 1
-
-                    lines.append(line)
-                    text_y += self.base_font_height + 2
-                    if text_y > self.height - self.base_font_height * 2:
-                        text_y = self.base_font_height
-                        parts.append(lines)
-                        lines = []
-
-        parts.append(lines)
-
-        return parts
+
+        yield lines
 
     def render(self, text: str, typo: bool, part: int):
         """Render image"""
-        part = self.split_text(text, typo)[part]
+        return self.render_part(self.split_text(text, typo)[part])
 
-        self._reset_line()
-        for line in part:
-            self._draw_line(line)
+    def _draw_segment(self, text_x, text_y, text, font, synthetic_bold, synthetic_italic):
+        """Draw text with a single font, synthesizing bold and italic if needed"""
+        stroke_width = max(1, font.size // 30) if synthetic_bold else 0
+        ascent, descent = font.getmetrics()
+        # Fonts are drawn from the ascender line, keep the baseline of the regular font
+        text_y += self.font.getmetrics()[0] - ascent
+
+        if synthetic_italic:
+            slant = int(ITALIC_SLANT * (ascent + descent)) + 1
+            mask = Image.new('L', (int(font.getlength(text)) + slant + 2 * stroke_width,
+                                   ascent + descent + 2 * stroke_width))
+            ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=255, stroke_width=stroke_width, stroke_fill=255)
+            mask = mask.transform(mask.size,
+                                  Image.AFFINE,
+                                  (1, ITALIC_SLANT, -ITALIC_SLANT * mask.size[1], 0, 1, 0),
+                                  resample=Image.BICUBIC)
+            self.image.paste(self.font_color, (int(text_x), text_y), mask)
+        else:
+            self._canvas.text((text_x, text_y),
+                              text,
+                              font=font,
+                              fill=self.font_color,
+                              stroke_width=stroke_width,
+                              stroke_fill=self.font_color)
+
+    def _draw_run(self, text_x, text_y, run):
+        """Draw text run, taking missing characters from the fallback fonts"""
+        _, font, synthetic_bold, synthetic_italic = self.fonts.resolve(run.style)
+        # Fallback fonts have no bold and italic variants
+        segment_x = text_x
+        for name, text in self.fonts.segments(run.text, run.style):
+            if name == EMOJI:
+                emoji = self.fonts.emoji.get(text, font.size)
+                emoji_y = text_y + self.font.getmetrics()[0] - self.fonts.emoji.ascent(font.size)
+                self.image.paste(emoji, (int(segment_x), emoji_y), emoji)
+                segment_x += emoji.size[0]
+                continue
+            segment_font = self.fonts.font(name)
+            self._draw_segment(segment_x,
+                               text_y,
+                               text,
+                               segment_font,
+                               synthetic_bold or (run.style.bold and segment_font is not font),
+                               synthetic_italic or (run.style.italic and segment_font is not font))
+            segment_x += self.fonts.width(text, run.style)
+
+        ascent = font.getmetrics()[0]
+        text_y += self.font.getmetrics()[0] - ascent
+        line_width = max(1, font.size // 15)
+        run_width = segment_x - text_x
+        if run.style.underline:
+            underline_y = text_y + ascent + line_width
+            self._canvas.line((text_x, underline_y, text_x + run_width, underline_y),
+                              fill=self.font_color,
+                              width=line_width)
+        if run.style.strikethrough:
+            strikethrough_y = text_y + ascent * 2 // 3
+            self._canvas.line((text_x, strikethrough_y, text_x + run_width, strikethrough_y),
+                              fill=self.font_color,
+                              width=line_width)
+
+    def render_part(self, lines):
+        """Render image from already split text part"""
+        self._new_canvas()
+        for text_x, text_y, run in self.layout_part(lines):
+            self._draw_run(text_x, text_y, run)
         return self.image
@@ -0,0 +1,29 @@
+"""
+In-memory caches
+"""
+import asyncio
+import time
+from functools import wraps
+
+
+def ttl_cache(ttl: float):
+    """Decorator keeping the result of a coroutine function without arguments for `ttl` seconds"""
+
+    def decorator(function):
+        # Result, the monotonic time it expires at and the lock, created in the event loop of the server
+        cached = [None, 0.0, None]
+
+        @wraps(function)
+        async def wrapper():
+            if cached[2] is None:
+                cached[2] = asyncio.Lock()
+            # Concurrent requests of an expired result wait for a single refresh
+            async with cached[2]:
+                if time.monotonic() >= cached[1]:
+                    cached[0] = await function()
+                    cached[1] = time.monotonic() + ttl
+                return cached[0]
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,64 @@
+"""
+Retention of solved errors: old ones are moved to the archive collection in batches
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from pymongo.errors import BulkWriteError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+INDEX_OPTIONS_CONFLICT_ERROR = 85
+
+
+def archive_query(cutoff: datetime) -> dict:
+    """Errors solved before the time, the ones solved before solved_at was stored by their timestamp"""
+    return {'solved': True,
+            '$or': [{'solved_at': {'$lt': cutoff}},
+                    {'solved_at': {'$exists': False}, 'timestamp': {'$lt': cutoff}}]}
+
+
+async def create_ttl_index(db, collection_name: str, expire_after: timedelta):
+    """Expire solved errors which were not archived in time, changing the period of an existing index"""
+    seconds = int(expire_after.total_seconds())
+    try:
+        await db[collection_name].create_index('solved_at', expireAfterSeconds=seconds)
+    except OperationFailure as exception:
+        if exception.code != INDEX_OPTIONS_CONFLICT_ERROR:
+            raise
+        await db.command('collMod', collection_name,
+                         index={'keyPattern': {'solved_at': 1}, 'expireAfterSeconds': seconds})
+
+
+async def archive_errors(errors_db, archive_db, cutoff: datetime, batch_size: int, pause: float) -> int:
+    """Move errors solved before the time to the archive a batch at a time, return the number of moved ones"""
+    moved = 0
+    while True:
+        batch = await errors_db.find(archive_query(cutoff)).sort('_id', 1).to_list(length=batch_size)
+        if not batch:
+            return moved
+        try:
+            await archive_db.insert_many(batch, ordered=False)
+        except BulkWriteError as exception:
+            # Errors copied by an interrupted run are in the archive already
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in exception.details['writeErrors']):
+                raise
+        await errors_db.delete_many({'_id': {'$in': [error['_id'] for error in batch]}})
+        moved += len(batch)
+        # Let the queries of the dashboard go between the batches
+        await asyncio.sleep(pause)
+
+
+async def archive_periodically(errors_db, archive_db, retention: timedelta, interval: float, batch_size: int,
+                               pause: float):
+    """Archive old solved errors every interval seconds until cancelled"""
+    while True:
+        try:
+            moved = await archive_errors(errors_db, archive_db, datetime.utcnow() - retention, batch_size, pause)
+            if moved:
+                logger.info('Archived %s solved errors', moved)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Errors archival failed')
+        await asyncio.sleep(interval)
@@ -0,0 +1,88 @@
+"""
+HTTP compression and caching
+"""
+import hashlib
+from functools import lru_cache
+
+from brotli_asgi import BrotliMiddleware
+from fastapi import Request, Response
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+# Smaller responses are sent as is, compression would barely save anything on them
+COMPRESSION_MINIMUM_SIZE = 500
+# Static files are used without asking the server for this long, then revalidated by the ETag
+STATIC_CACHE_CONTROL = 'public, max-age=3600'
+# API responses are always revalidated, unchanged ones come back as empty 304 responses
+API_CACHE_CONTROL = 'private, no-cache'
+
+
+class CompressionMiddleware:
+    """Brotli or gzip, whichever the client accepts, except for streams that must not be buffered"""
+
+    def __init__(self, app, uncompressed_paths=()):
+        self.app = app
+        self.uncompressed_paths = frozenset(uncompressed_paths)
+        self._compressing = BrotliMiddleware(app, minimum_size=COMPRESSION_MINIMUM_SIZE, gzip_fallback=True)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] not in self.uncompressed_paths:
+            await self._compressing(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether the If-None-Match header has the ETag, by weak comparison which ignores W/ prefixes"""
+    cached_etags = {tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')}
+    return '*' in cached_etags or etag.replace('W/', '', 1) in cached_etags
+
+
+@lru_cache(maxsize=256)
+def content_etag(path: str, mtime_ns: int, size: int) -> str:  # pylint: disable=unused-argument
+    """
+    Weak ETag of the file content, computed once per file version.
+
+    Weak, because the compression middleware sends the same file brotli, gzip or identity encoded
+    with the same tag, and strong ETags must differ between encodings.
+    """
+    with open(path, 'rb') as file:
+        return 'W/"' + hashlib.sha256(file.read()).hexdigest()[:32] + '"'
+
+
+class CachedStaticFiles(StaticFiles):
+    """Static files with weak ETags of their content and Cache-Control"""
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        etag = content_etag(str(full_path), stat_result.st_mtime_ns, stat_result.st_size)
+        response = FileResponse(full_path,
+                                status_code=status_code,
+                                stat_result=stat_result,
+                                method=scope['method'],
+                                headers={'ETag': etag, 'Cache-Control': STATIC_CACHE_CONTROL})
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def is_not_modified(self, response_headers: Headers, request_headers: Headers) -> bool:
+        if 'if-none-match' in request_headers:
+            return etag_matches(request_headers['if-none-match'], response_headers['etag'])
+        return super().is_not_modified(response_headers, request_headers)
+
+
+def api_etag(*parts) -> str:
+    """Weak ETag of a response built from the parts, equal in the raw and compressed form"""
+    return 'W/"' + hashlib.sha1('\n'.join(map(str, parts)).encode()).hexdigest() + '"'
+
+
+def cache_headers(etag: str) -> dict:
+    """Headers letting the client cache the API response and revalidate it"""
+    return {'ETag': etag, 'Cache-Control': API_CACHE_CONTROL}
+
+
+def not_modified(request: Request, etag: str):
+    """Empty 304 response if the client has the ETag cached, None otherwise"""
+    if etag_matches(request.headers.get('if-none-match', ''), etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    return None
@@ -0,0 +1,74 @@
+"""
+Load test of the admin API: many concurrent clients requesting an endpoint, latency percentiles and throughput.
+
+Compare runs with the concurrency below and above the server threadpool size (40 by default),
+blocking handlers queue up there while async ones keep going:
+
+    python load_test.py --url http://localhost --password ... --concurrency 10 50 200
+
+Run it against the compose stack with the real mongo service, before and after a change, on the same data:
+
+    git checkout <before> && docker-compose up -d --build web
+    python load_test.py --url http://localhost --password ...
+    git checkout <after> && docker-compose up -d --build web
+    python load_test.py --url http://localhost --password ...
+"""
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+
+
+def login(url: str, username: str, password: str) -> str:
+    """Cookie header of an authorized session"""
+    cookies = CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies))
+    request = urllib.request.Request(f'{url}/api/token',
+                                     data=json.dumps({'username': username, 'password': password}).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    opener.open(request).read()
+    return '; '.join(f'{cookie.name}={cookie.value}' for cookie in cookies)
+
+
+def timed_request(url: str, cookie: str) -> float:
+    """Seconds the whole response took"""
+    start = time.perf_counter()
+    with urllib.request.urlopen(urllib.request.Request(url, headers={'Cookie': cookie})) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def run(url: str, cookie: str, concurrency: int, requests: int) -> dict:
+    """Send the requests by this many clients at once"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(lambda _: timed_request(url, cookie), range(requests)))
+    elapsed = time.perf_counter() - start
+    return {'concurrency': concurrency,
+            'rps': round(requests / elapsed, 1),
+            'p50_ms': round(statistics.median(latencies) * 1000, 1),
+            'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+            'max_ms': round(latencies[-1] * 1000, 1)}
+
+
+def main():
+    """Load test command"""
+    parser = argparse.ArgumentParser(description='Load test of the admin API')
+    parser.add_argument('--url', default='http://localhost', help='admin app address')
+    parser.add_argument('--path', default='/api/errors?limit=100', help='endpoint to request')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200], help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per concurrency level')
+    args = parser.parse_args()
+
+    cookie = login(args.url, args.username, args.password)
+    for concurrency in args.concurrency:
+        print(run(args.url + args.path, cookie, concurrency, args.requests))
+
+
+if __name__ == '__main__':
+    main()
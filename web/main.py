@@ -1,28 +1,148 @@
 """Web"""
+import asyncio
+import json
+import os
+import uuid
+from datetime import date, datetime, time, timedelta
+from typing import List, Optional, Union
 
 from bson import ObjectId
-from fastapi import Depends, FastAPI, HTTPException, status
-from fastapi import Request
-from fastapi.responses import RedirectResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from bson.errors import InvalidId
+from fastapi import Depends, FastAPI, HTTPException, Query, status
+from fastapi import Request, Response
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi_jwt_auth import AuthJWT
 from fastapi_jwt_auth.exceptions import AuthJWTException, JWTDecodeError
+from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic.main import BaseModel
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, CursorType
+from pymongo.errors import CollectionInvalid
 
 from auth import authenticate_user, users_db
-from models import User
+from cache import ttl_cache
+from errors_archive import archive_periodically, create_ttl_index
+from http_cache import CachedStaticFiles, CompressionMiddleware, api_etag, cache_headers, not_modified
+from models import ErrorGroup, ErrorsPage, Message, Modified, RenderJob, SolveErrors, Stats, User
+from render_api import RenderWorkers, multipart_pages, zip_pages
+from responses import MongoJSONResponse, dumps
 from secrets import JWT_SECRET_KEY
 
-app = FastAPI(docs_url=None, redoc_url=None)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app = FastAPI(docs_url=None, redoc_url=None, default_response_class=MongoJSONResponse)
+# The live feed is flushed event by event, rendered pages are compressed images already
+app.add_middleware(CompressionMiddleware, uncompressed_paths={'/api/errors/events', '/api/render'})
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
 
-mongo_db = MongoClient('mongodb://mongo').instaimg
-configs_db = mongo_db.configs
-errors_db = mongo_db.errors
+MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://mongo')
+# Connections shared by all the concurrent requests
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+# Requests fail after these many milliseconds instead of hanging when MongoDB is unavailable or slow
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 30000))
+
+ERROR_FIELDS = ('chat_id', 'type', 'timestamp', 'msg')
+ERRORS_PAGE_SIZE = 100
+MAX_ERRORS_PAGE_SIZE = 1000
+ERROR_GROUPS_LIMIT = 50
+# MongoDB keeps naive UTC datetimes with millisecond precision
+EPOCH = datetime(1970, 1, 1)
+
+# Texts are rendered by this many processes, this many more may wait for them, others are refused
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 2))
+RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE', 8))
+# Pages limit of a rendered text, like for text documents in the bot
+MAX_RENDER_PAGES = 100
+
+# Statistics are served from memory for this many seconds
+STATS_CACHE_TTL = 60
+# Renders per day are listed for this many days
+STATS_DAYS = 30
+# Capped collection of new and solved errors written by the bot and the app, tailed by the live feed
+ERROR_EVENTS_SIZE = 16 * 1024 * 1024
+# Live feed sends a keep-alive comment when there were no events for this long, milliseconds
+ERROR_EVENTS_AWAIT_MS = 15000
+
+# Solved errors are moved to the archive after this many days
+ERRORS_RETENTION_DAYS = int(os.environ.get('ERRORS_RETENTION_DAYS', 30))
+# Solved errors which were not archived for some reason are deleted this many days later
+ERRORS_TTL_GRACE_DAYS = int(os.environ.get('ERRORS_TTL_GRACE_DAYS', 7))
+# Old solved errors are looked for every this many seconds, and moved this many at a time
+ARCHIVE_INTERVAL = 3600
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_PAUSE = 0.2
+
+
+#
+# MongoDB
+#
+
+@app.on_event('startup')
+async def connect_mongo():
+    """Create MongoDB client in the event loop of the server"""
+    app.state.mongo = AsyncIOMotorClient(MONGO_URL,
+                                         maxPoolSize=MONGO_MAX_POOL_SIZE,
+                                         serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                                         socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS)
+    errors_db = mongo_collection('errors')
+    # Errors are listed from the newest, unsolved ones of a type or of all types
+    await errors_db.create_index([('solved', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)])
+    await errors_db.create_index([('solved', ASCENDING), ('type', ASCENDING), ('timestamp', DESCENDING),
+                                  ('_id', DESCENDING)])
+    # Error groups kept by the bot, see bot/stats.py, are listed from the most frequent
+    await mongo_collection('error_groups').create_index([('count', DESCENDING)])
+    await mongo_collection('error_groups').create_index([('_id.type', ASCENDING), ('count', DESCENDING)])
+    await mongo_collection('error_groups_daily').create_index([('_id.day', ASCENDING)])
+    try:
+        await app.state.mongo.instaimg.create_collection('error_events', capped=True, size=ERROR_EVENTS_SIZE)
+    except CollectionInvalid:
+        pass
+    await create_ttl_index(app.state.mongo.instaimg,
+                           'errors',
+                           timedelta(days=ERRORS_RETENTION_DAYS + ERRORS_TTL_GRACE_DAYS))
+    await mongo_collection('errors_archive').create_index([('timestamp', DESCENDING), ('_id', DESCENDING)])
+
+
+@app.on_event('shutdown')
+def close_mongo():
+    """Close MongoDB connections"""
+    app.state.mongo.close()
+
+
+@app.on_event('startup')
+def start_archiver():
+    """Archive old solved errors in the background"""
+    app.state.archiver = asyncio.get_event_loop().create_task(
+        archive_periodically(mongo_collection('errors'),
+                             mongo_collection('errors_archive'),
+                             timedelta(days=ERRORS_RETENTION_DAYS),
+                             ARCHIVE_INTERVAL,
+                             ARCHIVE_BATCH_SIZE,
+                             ARCHIVE_PAUSE))
+
+
+@app.on_event('shutdown')
+def stop_archiver():
+    """Stop archiving, a batch left halfway is finished by the next run"""
+    app.state.archiver.cancel()
+
+
+@app.on_event('startup')
+def start_render_workers():
+    """Start render worker processes"""
+    app.state.render_workers = RenderWorkers(RENDER_WORKERS, RENDER_QUEUE_SIZE)
+
+
+@app.on_event('shutdown')
+def stop_render_workers():
+    """Stop render worker processes"""
+    app.state.render_workers.shutdown()
+
+
+def mongo_collection(name: str):
+    """Collection of the bot database"""
+    return app.state.mongo.instaimg[name]
 
 
 #
@@ -46,7 +166,7 @@ def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     return JSONResponse(status_code=exc.status_code, content={"detail": exc.message})
 
 
-@app.post("/api/token")
+@app.post("/api/token", response_model=Message)
 def login_for_access_token(form_data: User, authorize: AuthJWT = Depends()):
     """Check username and password and return a token"""
     user = authenticate_user(users_db, form_data.username, form_data.password)
@@ -61,7 +181,7 @@ def login_for_access_token(form_data: User, authorize: AuthJWT = Depends()):
     return {"msg": "Successfully login"}
 
 
-@app.delete('/api/logout')
+@app.delete('/api/logout', response_model=Message)
 def logout(authorize: AuthJWT = Depends()):
     """
     Because the JWT are stored in an httponly cookie now, we cannot
@@ -78,35 +198,334 @@ def logout(authorize: AuthJWT = Depends()):
 # API
 #
 
-@app.get("/api/errors")
-def get_errors(authorize: AuthJWT = Depends()):
-    """Get errors"""
+def error_cursor(error: dict) -> str:
+    """Position after the error in the errors list"""
+    return f'{(error["timestamp"] - EPOCH) // timedelta(milliseconds=1)}_{error["_id"]}'
+
+
+def parse_error_cursor(cursor: str):
+    """Timestamp and id of the error the cursor points after"""
+    try:
+        milliseconds, error_id = cursor.split('_')
+        return EPOCH + timedelta(milliseconds=int(milliseconds)), ObjectId(error_id)
+    except (ValueError, InvalidId) as exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor') from exception
+
+
+def time_bound(value: Union[datetime, date, None], end: bool = False) -> Optional[datetime]:
+    """Datetime of a time range bound, a date is its start or, for the end of the range, the next day start"""
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.combine(value + timedelta(days=1) if end else value, time.min)
+
+
+def errors_query(error_type: Optional[str], since: Union[datetime, date, None], until: Union[datetime, date, None],
+                 after: Optional[str]) -> dict:
+    """Unsolved errors filter, matching the errors indexes, the dates of the range are included"""
+    since, until = time_bound(since), time_bound(until, end=True)
+    query = {'solved': False}
+    if error_type:
+        query['type'] = error_type
+    if since or until:
+        query['timestamp'] = {}
+        if since:
+            query['timestamp']['$gte'] = since
+        if until:
+            query['timestamp']['$lt'] = until
+    if after:
+        timestamp, error_id = parse_error_cursor(after)
+        query['$or'] = [{'timestamp': {'$lt': timestamp}},
+                        {'timestamp': timestamp, '_id': {'$lt': error_id}}]
+    return query
+
+
+def error_item(error: dict, fields) -> dict:
+    """Error with the requested fields, values are left as they are for orjson to encode"""
+    item = {'id': error['_id']}
+    for field in fields:
+        if field in error:
+            item[field] = error[field]
+    return item
+
+
+@app.get("/api/errors", response_model=ErrorsPage, response_model_exclude_unset=True)
+async def get_errors(request: Request,
+                     authorize: AuthJWT = Depends(),
+                     limit: int = Query(ERRORS_PAGE_SIZE, ge=1, le=MAX_ERRORS_PAGE_SIZE),
+                     after: Optional[str] = None,
+                     type: Optional[str] = None,  # pylint: disable=redefined-builtin
+                     since: Union[datetime, date, None] = None,
+                     until: Union[datetime, date, None] = None,
+                     fields: Optional[str] = None,
+                     format: str = Query('json', regex='^(json|ndjson)$')):  # pylint: disable=redefined-builtin
+    """
+    Get unsolved errors from the newest, a page at a time.
+
+    The next page starts after the `next` cursor of the previous one. `fields` is a comma-separated
+    subset of the error fields. NDJSON format streams all the errors after the cursor, one per line.
+    """
+    authorize.jwt_required()
+    selected_fields = ERROR_FIELDS
+    if fields:
+        selected_fields = tuple(field for field in fields.split(',') if field in ERROR_FIELDS)
+    # Timestamp is needed for the cursor
+    projection = dict.fromkeys({*selected_fields, 'timestamp'}, 1)
+
+    found = mongo_collection('errors').find(errors_query(type, since, until, after), projection) \
+        .sort([('timestamp', DESCENDING), ('_id', DESCENDING)])
+
+    if format == 'ndjson':
+        async def lines():
+            async for error in found.batch_size(ERRORS_PAGE_SIZE):
+                yield dumps(error_item(error, selected_fields)) + b'\n'
+        return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+    etag = api_etag(await errors_version(), request.url.query)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+
+    page = await found.to_list(length=limit + 1)
+    next_cursor = error_cursor(page[limit - 1]) if len(page) > limit else None
+    # Encoded straight from the documents, validating and encoding thousands of them by the model is slow
+    return MongoJSONResponse({'errors': [error_item(error, selected_fields) for error in page[:limit]],
+                              'next': next_cursor},
+                             headers=cache_headers(etag))
+
+
+async def errors_version():
+    """Id of the latest error event, it changes whenever an error is added or solved"""
+    latest = await mongo_collection('error_events').find_one(sort=[('$natural', DESCENDING)], projection={'_id': True})
+    return latest['_id'] if latest else None
+
+
+@app.get("/api/errors/archive")
+async def get_archived_errors(authorize: AuthJWT = Depends(),
+                              type: Optional[str] = None,  # pylint: disable=redefined-builtin
+                              since: Union[datetime, date, None] = None,
+                              until: Union[datetime, date, None] = None):
+    """Export archived solved errors from the newest as NDJSON, one error per line"""
+    authorize.jwt_required()
+    query = errors_query(type, since, until, None)
+    # Every archived error is solved
+    del query['solved']
+    found = mongo_collection('errors_archive').find(query).sort([('timestamp', DESCENDING), ('_id', DESCENDING)])
+
+    async def lines():
+        async for error in found.batch_size(ERRORS_PAGE_SIZE):
+            yield dumps(error_item(error, (*ERROR_FIELDS, 'solved_at'))) + b'\n'
+    return StreamingResponse(lines(),
+                             media_type='application/x-ndjson',
+                             headers={'Content-Disposition': 'attachment; filename="errors-archive.ndjson"'})
+
+
+def error_group_item(group: dict, count: int) -> dict:
+    """Error group with the count of its errors"""
+    return {'type': group['_id']['type'],
+            'key': group['_id']['key'],
+            'count': count,
+            'msg': group.get('msg'),
+            'first_seen': group.get('first_seen'),
+            'last_seen': group.get('last_seen')}
+
+
+@app.get("/api/errors/groups", response_model=List[ErrorGroup])
+async def get_error_groups(request: Request,
+                           response: Response,
+                           authorize: AuthJWT = Depends(),
+                           type: Optional[str] = None,  # pylint: disable=redefined-builtin
+                           days: Optional[int] = Query(None, ge=1),
+                           limit: int = Query(ERROR_GROUPS_LIMIT, ge=1, le=MAX_ERRORS_PAGE_SIZE)):
+    """
+    Get the most frequent errors grouped by type and normalized message.
+
+    Errors are counted for all the time or for the last `days` days.
+    """
+    authorize.jwt_required()
+    # Windows of days move at midnight
+    etag = api_etag(await errors_version(), f'{datetime.utcnow():%Y-%m-%d}', request.url.query)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+    response.headers.update(cache_headers(etag))
+
+    groups_db = mongo_collection('error_groups')
+    if days is None:
+        found = groups_db.find({'_id.type': type} if type else {}).sort('count', DESCENDING).limit(limit)
+        return [error_group_item(group, group['count']) async for group in found]
+
+    query = {'_id.day': {'$gte': f'{datetime.utcnow() - timedelta(days=days - 1):%Y-%m-%d}'}}
+    if type:
+        query['_id.type'] = type
+    # Daily counts are few compared to the errors themselves
+    counts = await mongo_collection('error_groups_daily').aggregate([
+        {'$match': query},
+        {'$group': {'_id': {'type': '$_id.type', 'key': '$_id.key'}, 'count': {'$sum': '$count'}}},
+        {'$sort': {'count': -1}},
+        {'$limit': limit},
+    ]).to_list(length=limit)
+    groups = {(group['_id']['type'], group['_id']['key']): group
+              async for group in groups_db.find({'_id': {'$in': [count['_id'] for count in counts]}})}
+    return [error_group_item(groups.get((count['_id']['type'], count['_id']['key']), count), count['count'])
+            for count in counts]
+
+
+def error_event_data(event: dict) -> dict:
+    """Live feed message of the error event"""
+    if event['event'] == 'new':
+        return {'event': 'new', 'error': error_item(event['error'], ERROR_FIELDS)}
+    return {'event': event['event'], 'condition': event['condition']}
+
+
+async def error_events(last_id: Optional[ObjectId]):
+    """Server-sent events of the error events after the id, tailing the capped collection"""
+    events_db = mongo_collection('error_events')
+    while True:
+        query = {} if last_id is None else {'_id': {'$gt': last_id}}
+        cursor = events_db.find(query, cursor_type=CursorType.TAILABLE_AWAIT).max_await_time_ms(ERROR_EVENTS_AWAIT_MS)
+        while cursor.alive:
+            async for event in cursor:
+                last_id = event['_id']
+                yield f'id: {last_id}\ndata: {dumps(error_event_data(event)).decode()}\n\n'
+            yield ': keep-alive\n\n'
+        # Cursors of an empty capped collection die at once
+        await asyncio.sleep(1)
+
+
+@app.get("/api/errors/events")
+async def get_error_events(request: Request, authorize: AuthJWT = Depends()):
+    """Stream new and solved errors as server-sent events, from the last received one when reconnected"""
     authorize.jwt_required()
-    found_errors = []
-    for error in errors_db.find({'solved': False}):
-        list_error = {'chat_id': error['chat_id'],
-                      'type': error['type'],
-                      'timestamp': error['timestamp'],
-                      'msg': error['msg'],
-                      'id': str(error['_id'])}
-        found_errors.append(list_error)
-    return found_errors
-
-
-@app.get("/api/mark_as_solved")
-def mark_as_solved(error_id: str, authorize: AuthJWT = Depends()):
+    try:
+        last_id = ObjectId(request.headers['last-event-id'])
+    except (KeyError, InvalidId, TypeError):
+        # Only the events after the connection
+        latest = await mongo_collection('error_events').find_one(sort=[('$natural', DESCENDING)])
+        last_id = latest['_id'] if latest else None
+    return StreamingResponse(error_events(last_id), media_type='text/event-stream')
+
+
+async def add_solved_event(condition: dict):
+    """Let the live feeds drop the solved errors"""
+    condition = {key: value.isoformat() if isinstance(value, datetime) else value
+                 for key, value in condition.items() if value}
+    await mongo_collection('error_events').insert_one({'event': 'solved', 'condition': condition})
+
+
+def parse_error_ids(error_ids) -> list:
+    """ObjectIds of the errors"""
+    try:
+        return [ObjectId(error_id) for error_id in error_ids]
+    except (InvalidId, TypeError) as exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid error id') from exception
+
+
+@app.get("/api/mark_as_solved", response_model=Modified)
+async def mark_as_solved(error_id: str, authorize: AuthJWT = Depends()):
     """Mark error as solved"""
     authorize.jwt_required()
-    error = errors_db.find_one(ObjectId(error_id))
-    if error:
-        errors_db.update_one({'_id': error['_id']}, {'$set': {'solved': True}})
+    result = await mongo_collection('errors').update_one({'_id': parse_error_ids([error_id])[0], 'solved': False},
+                                                         {'$set': {'solved': True, 'solved_at': datetime.utcnow()}})
+    if result.modified_count:
+        await add_solved_event({'ids': [error_id]})
+    return {'modified': result.modified_count}
+
 
+@app.post("/api/errors/solve", response_model=Modified)
+async def solve_errors(errors: SolveErrors, authorize: AuthJWT = Depends()):
+    """Mark errors by ids, type, message and time range as solved at once"""
+    authorize.jwt_required()
+    query = errors_query(errors.type, errors.since, errors.until, None)
+    if errors.ids is not None:
+        query['_id'] = {'$in': parse_error_ids(errors.ids)}
+    if errors.msg:
+        query['msg'] = errors.msg
+    if len(query) == 1:
+        # Only the unsolved condition, solving all the errors is not a misclick away
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='No errors condition')
+
+    result = await mongo_collection('errors').update_many(query,
+                                                          {'$set': {'solved': True, 'solved_at': datetime.utcnow()}})
+    if result.modified_count:
+        # Live feeds match the errors by the same datetimes
+        await add_solved_event({**errors.dict(),
+                                'since': time_bound(errors.since),
+                                'until': time_bound(errors.until, end=True)})
+    return {'modified': result.modified_count}
+
+
+def period_ids(now: datetime) -> tuple:
+    """Stats document ids of the day, ISO week and month of the time"""
+    # Copy of period_starts in bot/stats.py, which names the documents, the web app doesn't import bot modules
+    iso_year, iso_week, _ = now.isocalendar()
+    return f'day:{now:%Y-%m-%d}', f'week:{iso_year}-W{iso_week:02}', f'month:{now:%Y-%m}'
+
+
+@ttl_cache(STATS_CACHE_TTL)
+async def read_stats() -> dict:
+    """Users and renders statistics from the counters"""
+    now = datetime.utcnow()
+    days = [period_ids(now - timedelta(days=days_ago))[0] for days_ago in reversed(range(STATS_DAYS))]
+    day_id, week_id, month_id = period_ids(now)
+    # Counters kept by the bot, see bot/stats.py
+    found = mongo_collection('stats').find({'_id': {'$in': ['total', week_id, month_id, *days]}})
+    counters = {document['_id']: document async for document in found}
+
+    total = counters.get('total', {})
+    renders = total.get('renders', 0)
+    return {'users': total.get('users', 0),
+            'dau': counters.get(day_id, {}).get('active', 0),
+            'wau': counters.get(week_id, {}).get('active', 0),
+            'mau': counters.get(month_id, {}).get('active', 0),
+            'renders_per_day': [{'day': day[len('day:'):], 'renders': counters.get(day, {}).get('renders', 0)}
+                                for day in days],
+            'pages_per_render': round(total.get('pages', 0) / renders, 2) if renders else 0}
+
+
+@app.get("/api/stats", response_model=Stats)
+async def get_stats(request: Request, response: Response, authorize: AuthJWT = Depends()):
+    """Get Bot users and renders statistics"""
+    authorize.jwt_required()
+    stats = await read_stats()
+    etag = api_etag(json.dumps(stats, sort_keys=True))
+    response.headers.update(cache_headers(etag))
+    return not_modified(request, etag) or stats
 
-@app.get("/api/users/count")
-def get_users_count(authorize: AuthJWT = Depends()):
+
+@app.get("/api/users/count", response_model=int)
+async def get_users_count(request: Request, response: Response, authorize: AuthJWT = Depends()):
     """Get Bot users count"""
     authorize.jwt_required()
-    return configs_db.find().count()
+    users = (await read_stats())['users']
+    etag = api_etag(users)
+    response.headers.update(cache_headers(etag))
+    return not_modified(request, etag) or users
+
+
+@app.post("/api/render")
+async def render(job: RenderJob, authorize: AuthJWT = Depends()):
+    """
+    Render text pages as the bot does and return them in a zip archive or a multipart/mixed response.
+
+    Config fields missing or invalid are the default ones. The X-Pages-Truncated header is set
+    when the text has more than MAX_RENDER_PAGES pages.
+    """
+    authorize.jwt_required()
+    rendered = await app.state.render_workers.render(job.config, job.text, MAX_RENDER_PAGES)
+    if rendered is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Too many texts are being rendered',
+                            headers={'Retry-After': '1'})
+    pages, truncated = rendered
+
+    headers = {'X-Pages-Truncated': 'true' if truncated else 'false'}
+    if job.format == 'multipart':
+        boundary = uuid.uuid4().hex
+        return StreamingResponse(multipart_pages(pages, boundary),
+                                 media_type=f'multipart/mixed; boundary={boundary}',
+                                 headers=headers)
+    headers['Content-Disposition'] = 'attachment; filename="pages.zip"'
+    return Response(zip_pages(pages), media_type='application/zip', headers=headers)
 
 
 #
@@ -129,6 +548,16 @@ def errors(request: Request, authorize: AuthJWT = Depends()):
     return templates.TemplateResponse("errors.html", {"request": request})
 
 
+@app.get("/errors/groups")
+def error_groups(request: Request, authorize: AuthJWT = Depends()):
+    """Error groups page"""
+    authorize.jwt_optional()
+
+    if not authorize.get_jwt_subject():
+        return RedirectResponse('/login')
+    return templates.TemplateResponse("error_groups.html", {"request": request})
+
+
 @app.get("/login")
 def login(request: Request):
     """Login page"""
@@ -1,9 +1,10 @@
 """
 Web Data Models
 """
-from typing import Optional
+from datetime import date, datetime
+from typing import List, Optional, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class Token(BaseModel):
@@ -23,3 +24,66 @@ class User(BaseModel):
 class DBUser(BaseModel):
     username: str
     hashed_password: str
+
+
+class SolveErrors(BaseModel):
+    """Errors to mark as solved, all the given conditions must match, the dates of the range are included"""
+    ids: Optional[List[str]] = None
+    type: Optional[str] = None
+    msg: Optional[str] = None
+    since: Union[datetime, date, None] = None
+    until: Union[datetime, date, None] = None
+
+
+class RenderJob(BaseModel):
+    """Text to render with config fields in the stored form, e.g. {'font-size': 40, 'font-color': [255, 0, 0]}"""
+    text: str = Field(..., min_length=1, max_length=100000)
+    config: dict = {}
+    format: str = Field('zip', regex='^(zip|multipart)$')
+
+
+class Message(BaseModel):
+    msg: str
+
+
+class Error(BaseModel):
+    """Error with the requested fields"""
+    id: str
+    chat_id: Optional[int]
+    type: Optional[str]
+    timestamp: Optional[datetime]
+    msg: Optional[str]
+    # Set for archived errors only
+    solved_at: Optional[datetime]
+
+
+class ErrorsPage(BaseModel):
+    errors: List[Error]
+    next: Optional[str]
+
+
+class ErrorGroup(BaseModel):
+    type: str
+    key: str
+    count: int
+    msg: Optional[str]
+    first_seen: Optional[datetime]
+    last_seen: Optional[datetime]
+
+
+class Modified(BaseModel):
+    modified: int
+
+
+class DayRenders(BaseModel):
+    day: str
+    renders: int
+
+
+class Stats(BaseModel):
+    users: int
+    dau: int
+    wau: int
+    mau: int
+    renders_per_day: List[DayRenders]
+    pages_per_render: float
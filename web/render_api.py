@@ -0,0 +1,80 @@
+"""
+Text rendering for the HTTP API by the bot rendering code, in worker processes
+"""
+import asyncio
+import io
+import os
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+WEB_DIR = Path(__file__).resolve().parent
+# Bot code with its fonts, the image has it next to the web app
+BOT_DIR = Path(os.environ.get('BOT_DIR', WEB_DIR.parent / 'bot')).resolve()
+
+MEDIA_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+def _init_worker(bot_dir: str, web_dir: str):
+    """Let the worker import the bot code, which finds its fonts relative to the working directory"""
+    os.chdir(bot_dir)
+    # Bot modules come first, some of them are named like the web ones
+    sys.path[:0] = [bot_dir, web_dir]
+
+
+def _render_job(document: dict, text: str, max_pages: int):
+    """Render text pages in a worker process, return their file names and data and whether the text was cut"""
+    # Imported from the bot directory, fonts stay loaded in the worker between the jobs
+    from config import UserConfig  # pylint: disable=import-outside-toplevel
+    from rendering import create_renderer, encode_image, split_pages  # pylint: disable=import-outside-toplevel
+
+    tti = create_renderer(UserConfig.from_document(document))
+    parts = split_pages(tti, text)
+    pages = []
+    for number, part in enumerate(parts[:max_pages], start=1):
+        page = encode_image(tti.render_part(part))
+        pages.append((f'{number:03}.{page.name.rsplit(".", 1)[1]}', page.getvalue()))
+    return pages, len(parts) > max_pages
+
+
+class RenderWorkers:
+    """Processes rendering texts, with a bounded number of texts waiting for them"""
+
+    def __init__(self, workers: int, queue_size: int):
+        self._executor = ProcessPoolExecutor(workers,
+                                             mp_context=get_context('spawn'),
+                                             initializer=_init_worker,
+                                             initargs=(str(BOT_DIR), str(WEB_DIR)))
+        self._slots = asyncio.Semaphore(workers + queue_size)
+
+    async def render(self, document: dict, text: str, max_pages: int):
+        """Pages and whether the text was cut, None if too many texts are being rendered already"""
+        if self._slots.locked():
+            return None
+        async with self._slots:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, _render_job, document, text,
+                                                                  max_pages)
+
+    def shutdown(self):
+        """Stop worker processes"""
+        self._executor.shutdown()
+
+
+def zip_pages(pages) -> bytes:
+    """Zip archive of the pages, stored as they are, images are compressed already"""
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_file:
+        for name, data in pages:
+            zip_file.writestr(name, data)
+    return archive.getvalue()
+
+
+def multipart_pages(pages, boundary: str):
+    """Parts of a multipart/mixed body with the pages"""
+    for name, data in pages:
+        media_type = MEDIA_TYPES[name.rsplit('.', 1)[1]]
+        yield (f'--{boundary}\r\nContent-Type: {media_type}\r\n'
+               f'Content-Disposition: attachment; filename="{name}"\r\n\r\n').encode() + data + b'\r\n'
+    yield f'--{boundary}--\r\n'.encode()
@@ -0,0 +1,25 @@
+"""
+JSON encoding of MongoDB documents
+"""
+import orjson
+from bson import ObjectId
+from fastapi.responses import ORJSONResponse
+
+
+def _default(value):
+    """Types orjson doesn't know, datetimes are encoded by orjson itself"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError
+
+
+def dumps(content) -> bytes:
+    """JSON of documents as they come from MongoDB"""
+    return orjson.dumps(content, default=_default)
+
+
+class MongoJSONResponse(ORJSONResponse):
+    """JSON response encoded by orjson, with ObjectIds as strings"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)